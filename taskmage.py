@@ -2,122 +2,3407 @@
 """
 A module that manages task lists.
 
+Run as a script, it adds, lists and completes tasks in the .csv file of the 
+current directory without an interactive interface; see :func:`main`.
+
 Exported Classes:
 
-TaskListCSV -- Manages task lists with a .csv file backend.
+TaskListCSV -- Manages task lists with a .csv file backend.
+
+TaskListMmap -- Accesses single tasks in the .csv file by uid.
+
+TaskListSQLite -- Manages task lists with a SQLite database backend.
+
+TaskListRegistry -- Opens task lists by name and keeps recently used ones.
+
+Task -- Defines task properties.
+
+UidGenerator -- Generates unique task identifiers.
+
+WriteBehind -- Writes a task list from a background thread.
+
+SessionLog -- Records timing sessions and keeps time totals.
+
+TimerSet -- Runs timers on several tasks and checkpoints them to a file.
+
+TextIndex -- Finds tasks by the words in their summary and description.
+
+SortedIndex -- Keeps tasks sorted by an attribute for range lookups.
+
+Query -- Selects tasks by a condition on their attributes.
+
+Equal, Range, Prefix -- Select tasks by the value of an attribute.
+
+And, Or, Not -- Combine queries.
+
+Stats -- Collects call timings and counters of the hot paths.
+
+Setting the TASKMAGE_STATS environment variable to a file name turns on 
+:data:`stats`; the collected figures are written to that file on exit.
+"""
+
+import atexit
+import bisect
+import errno
+import gc
+import glob
+import hashlib
+import marshal
+import mmap
+import operator
+import os
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime, timedelta
+from itertools import count, izip
+# Modules that only some commands need, such as gzip, json, multiprocessing,
+# socket and sqlite3, are imported where they are used to keep startup fast
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where task list files are not locked
+    fcntl = None
+
+# Task attributes, in the order they are stored in each line of the .csv file
+FIELDS = ('uid', 'summary', 'description', 'date', 'status', 'logged_time')
+_UID = FIELDS.index('uid')
+_DATE = FIELDS.index('date')
+_STATUS = FIELDS.index('status')
+# Task statuses, the same as those of iCalendar to-dos (VTODO)
+STATUSES = ('needs-action', 'in-process', 'completed', 'cancelled')
+
+class Stats(object):
+
+    """
+    Collect call timings and counters of the hot paths.
+
+    Timings are kept per name, for the last :attr:`samples` calls, so that
+    percentiles reflect recent use in a long session. Counters are plain 
+    running totals. All methods may be called from any thread.
+
+    Data attributes:
+
+    .. attribute:: filename
+
+        File written by :meth:`dump`, or None.
+
+    .. attribute:: samples
+
+        Number of timings kept per name.
+
+    Public functions:
+
+    record -- Record the duration of a call.
+
+    add -- Add a value to a counter.
+
+    summary -- Return the call counts, percentiles and counters.
+
+    dump -- Write the summary to a file as JSON.
+
+    """
+
+    samples = 10000
+
+    def __init__(self, filename=None):
+        """Start with no timings and counters.
+
+        :param filename: File written by :meth:`dump` by default.
+
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._totals = {}
+        self._timings = {}
+        self._counters = {}
+
+    def record(self, name, seconds):
+        """Record that a call to name took seconds."""
+        with self._lock:
+            timings = self._timings.get(name)
+            if timings is None:
+                timings = self._timings[name] = deque(maxlen=self.samples)
+                self._calls[name] = 0
+                self._totals[name] = 0.0
+            timings.append(seconds)
+            self._calls[name] += 1
+            self._totals[name] += seconds
+
+    def add(self, name, value=1):
+        """Add value to the counter name."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        """Return the call counts, percentiles and counters.
+
+        Return a dictionary with a 'calls' dictionary mapping each timed name
+        to its call count, total seconds and the 50th and 99th percentiles of
+        its recent timings, in seconds, and a 'counters' dictionary mapping 
+        counter names to their values.
+
+        """
+        with self._lock:
+            timings = dict((name, sorted(values)) 
+                           for name, values in self._timings.iteritems())
+            calls = dict(self._calls)
+            totals = dict(self._totals)
+            counters = dict(self._counters)
+        summary = {}
+        for name, values in timings.iteritems():
+            summary[name] = {'calls': calls[name],
+                             'total': totals[name],
+                             'p50': percentile(values, 50),
+                             'p99': percentile(values, 99)}
+        return {'calls': summary, 'counters': counters}
+
+    def dump(self, filename=None):
+        """Write the summary to filename, or :attr:`filename`, as JSON."""
+        filename = filename or self.filename
+        if not filename:
+            return
+        import json
+        with open(filename, "w") as fh:
+            json.dump(self.summary(), fh, indent=2, sort_keys=True)
+            fh.write('\n')
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values, or None."""
+    if not values:
+        return None
+    rank = max(int(len(values) * percent / 100.0 + 0.5), 1)
+    return values[min(rank, len(values)) - 1]
+
+def instrumented(name):
+    """Return a decorator that records the timings of calls under name.
+
+    When :data:`stats` is None, the decorated function is returned as is, 
+    so the hooks cost nothing unless statistics were asked for at startup.
+
+    """
+    def decorate(function):
+        if stats is None:
+            return function
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.record(name, time.time() - start)
+        return timed
+    return decorate
+
+# Statistics of the hot paths, or None unless TASKMAGE_STATS names a file
+stats = None
+if os.environ.get('TASKMAGE_STATS'):
+    stats = Stats(os.environ['TASKMAGE_STATS'])
+    atexit.register(stats.dump)
+
+class TaskListCSV(object):
+
+    """
+    Manage task list with a .csv file backend.
+
+    Data attributes:
+
+    .. attribute:: tasks
+
+        A list of Task objects.
+
+    .. attribute:: journal
+
+        If True, :meth:`write_tasks` appends changes to an append-only journal
+        instead of rewriting the whole .csv file.
+
+    .. attribute:: uids
+
+        A dictionary mapping each task uid to its :class:`Task` object.
+
+    .. attribute:: indexes
+
+        A dictionary whose keys are the :attr:`indexed_attributes` and whose
+        values are dictionaries mapping each attribute value to the set of 
+        tasks with that value.
+
+    .. attribute:: loaded
+
+        False while a lazy task list holds only tasks whose status is one of
+        :attr:`active_statuses`; True once all tasks in the .csv file and 
+        journal have been read.
+
+    .. attribute:: archive
+
+        If True, :meth:`compact` moves tasks whose status is not one of 
+        :attr:`active_statuses` out of the .csv file, into gzip compressed
+        archive segments, one for each month the tasks were created in.
+
+    .. attribute:: archive_loaded
+
+        True once the archived tasks have been read, which 
+        :meth:`filter_tasks` does when asked for tasks with other statuses 
+        than :attr:`active_statuses`.
+
+    .. attribute:: fsync
+
+        When written data is forced to disk: 'always' after every write,
+        'rewrite' only after rewriting the whole .csv file, or 'never'.
+
+    .. attribute:: lock
+
+        A reentrant lock held while the task list is read or changed, so that
+        a :class:`WriteBehind` thread can write it while the user edits it.
+
+    .. attribute:: text_index
+
+        The :class:`TextIndex` of the loaded tasks, or None until the first
+        call to :meth:`search_tasks`.
+
+    .. attribute:: sorted_indexes
+
+        A dictionary mapping each of the :attr:`sorted_attributes` to its 
+        :class:`SortedIndex`, built by the first :meth:`query` that can use
+        it and kept up to date afterwards.
+
+    .. attribute:: filename
+
+        The .csv file. The names of the journal, cache, text index, lock and
+        archive files are derived from it; for the default, 'tasks.csv',
+        they are those given below.
+
+    Other processes may use the same files. Writes hold an exclusive lock on
+    the lock file and first merge the changes those processes made, so none 
+    are overwritten; :meth:`refresh` merges them on demand.
+
+    Public functions:
+
+    add_task -- Add a Task object to the task list.
+
+    add_tasks -- Add many Task objects to the task list and write them at once.
+
+    update_task -- Change task attributes and record the change.
+
+    filter_tasks -- Return a list of tasks that match certain criteria.
+
+    query -- Return a list of the tasks that match a :class:`Query`.
+
+    search_tasks -- Return the tasks that contain the words of a query.
+
+    save_text_index -- Write the text index to its file.
+
+    read_tasks -- Read tasks from .csv file.
+
+    refresh -- Merge changes made to the files by other processes.
+
+    iter_tasks -- Iterate tasks in .csv file that match certain criteria.
+
+    iter_uids -- Iterate the uids of the tasks in the .csv file.
+
+    append_tasks -- Append tasks to the .csv file without reading it.
+
+    append_statuses -- Record a status for many tasks without reading them.
+
+    load_all -- Read the tasks left out by lazy mode.
+
+    load_archive -- Read the archived tasks.
+
+    write_tasks -- Write tasks to .csv file.
+
+    compact -- Fold the journal back into the .csv file.
+
+    """
+
+    filename = "tasks.csv"
+    journal_filename = "tasks.journal"
+    # Snapshot of the decoded .csv file, used by read_tasks while valid
+    cache_filename = "tasks.csv.cache"
+    # Text index saved by save_text_index, used while the files are unchanged
+    text_index_filename = "tasks.csv.words"
+    # Locked while the files are read or written
+    lock_filename = "tasks.csv.lock"
+    # Archive segments, by the year and month the tasks were created
+    archive_filename = "tasks.csv.%s.gz"
+    # The journal is compacted when it grows past journal_max_bytes, or past
+    # journal_max_ratio times the size of the .csv file (but not before it
+    # reaches journal_min_bytes, so small lists are not compacted constantly)
+    journal_max_bytes = 1024 * 1024
+    journal_min_bytes = 64 * 1024
+    journal_max_ratio = 0.25
+    # Task attributes with a hash index, kept up to date by add_task and
+    # update_task; uids have their own one-to-one index
+    indexed_attributes = ('status',)
+    # Task attributes that range and prefix queries find by bisection
+    sorted_attributes = ('date', 'logged_time')
+    # Statuses read at startup in lazy mode
+    active_statuses = ('needs-action', 'in-process')
+    fsync_policies = ('always', 'rewrite', 'never')
+    # Without a valid snapshot cache, .csv files of at least this size are 
+    # parsed by a pool of parallel_processes processes (one per CPU if None)
+    parallel_min_bytes = 16 * 1024 * 1024
+    parallel_processes = None
+
+    def __init__(self, journal=False, lazy=False, fsync='rewrite', 
+                 read=True, archive=False, filename=None):
+        """Initialize task list and read tasks from .csv file.
+
+        :param journal: If True, persist changes through the journal.
+        :param lazy: If True, read only tasks with an active status; other 
+                     tasks are read when :meth:`filter_tasks` asks for them.
+        :param fsync: One of :attr:`fsync_policies`.
+        :param archive: If True, archive finished tasks when compacting.
+        :param read: If False, read no tasks, for use with the streaming 
+                     methods :meth:`iter_tasks`, :meth:`iter_uids`, 
+                     :meth:`append_tasks` and :meth:`append_statuses` 
+                     only.
+        :param filename: The .csv file, if not :attr:`filename`.
+
+        """
+        if fsync not in self.fsync_policies:
+            raise ValueError("Unknown fsync policy: %r" % (fsync,))
+        if filename is not None and filename != self.filename:
+            self.filename = filename
+            self.journal_filename = os.path.splitext(filename)[0] + ".journal"
+            self.cache_filename = filename + ".cache"
+            self.text_index_filename = filename + ".words"
+            self.lock_filename = filename + ".lock"
+            self.archive_filename = filename.replace('%', '%%') + ".%s.gz"
+        self.tasks = []
+        self.journal = journal
+        self.loaded = not lazy
+        self.archive = archive
+        self.archive_loaded = False
+        self.fsync = fsync
+        self.lock = threading.RLock()
+        # Serializes writers, so journal records are appended in order
+        self._write_lock = threading.Lock()
+        # Change records not yet written by write_tasks, which appends them
+        # to the journal in journal mode; merges keep their attributes
+        self._pending = []
+        self.uids = {}
+        self.indexes = dict((attr, {}) for attr in self.indexed_attributes)
+        self.text_index = None
+        self.sorted_indexes = {}
+        # Uids of the loaded tasks that live in the archive segments
+        self._archived = set()
+        # Inode, modification time and size of the .csv file when it was 
+        # last read or written, and inode and length of the journal read
+        self._base_stat = None
+        self._journal_seen = None
+        # Whether a merge changed the loaded tasks since refresh last 
+        # returned, including merges done by write_tasks and compact
+        self._merged = False
+        if read:
+            self.read_tasks()
+
+    def add_task(self, task):
+        """Add a Task object to the task list.
+
+        :param task: Task object to append. Currently, no check is made to 
+                     ensure this is indeed a Task instance.
+
+        Append task to :attr:`tasks`, add it to the indexes and return it.
+        
+        """
+        with self.lock:
+            self.tasks.append(task)
+            self._index_task(task)
+            self._pending.append(['add'] + task_fields(task))
+        return task
+
+    def add_tasks(self, tasks):
+        """Add many Task objects to the task list and write them at once.
+
+        :param tasks: Iterable of Task objects.
+
+        Add each task with :meth:`add_task`, then call :meth:`write_tasks` 
+        once. Return the list of added tasks.
+
+        """
+        with self.lock, paused_gc():
+            added = [self.add_task(task) for task in tasks]
+        self.write_tasks()
+        return added
+
+    def update_task(self, task, **kwargs):
+        """Change task attributes and record the change.
+
+        :param task: :class:`Task` object to change.
+        :param \*\*kwargs: A dictionary whose keys are :class:`Task` object
+                         attributes and whose values are the new values for
+                         each attribute. For example:
+
+        {status: 'completed'}
+
+        Set each attribute and queue a change record for the next 
+        :meth:`write_tasks`, which appends it to the journal in journal mode.
+        In every mode, the queued records keep merges from overwriting the
+        changed attributes until they are written. A changed archived task 
+        is added back to the .csv file, which takes precedence over the 
+        archive. Return task.
+
+        """
+        with self.lock:
+            if task.uid in self._archived:
+                self._archived.discard(task.uid)
+                for attr, value in kwargs.iteritems():
+                    self._set_attribute(task, attr, value)
+                self._pending.append(['add'] + task_fields(task))
+                return task
+            for attr, value in kwargs.iteritems():
+                self._set_attribute(task, attr, value)
+                if attr == 'status':
+                    self._pending.append(['status', task.uid, value])
+                else:
+                    self._pending.append(['update', task.uid, attr, 
+                                          str(value)])
+        return task
+
+    @instrumented('read_tasks')
+    def read_tasks(self):
+        """Read tasks from .csv file.
+
+        For each line in the tasks.csv file, with journal changes applied, 
+        create a :class:`Task` object. Append each object to :attr:`tasks`.
+        In lazy mode, skip lines whose status is not one of 
+        :attr:`active_statuses` before creating the object. Remember the 
+        state of the files, so that :meth:`refresh` can find what changed.
+
+        """
+        with self._file_lock(shared=True):
+            self._base_stat = file_stat(self.filename)
+            rows = self._iter_rows(track=True)
+            if not self.loaded:
+                active_statuses = self.active_statuses
+                rows = (fields for fields in rows 
+                        if fields[_STATUS] in active_statuses)
+            loaded = len(self.tasks)
+            with paused_gc():
+                for fields in rows:
+                    task = Task(*fields)
+                    self.tasks.append(task)
+                    self._index_task(task)
+            if stats is not None:
+                stats.add('tasks_loaded', len(self.tasks) - loaded)
+
+    @instrumented('refresh')
+    def refresh(self):
+        """Merge changes made to the files by other processes.
+
+        If the journal has grown, read only the new records; if the .csv file
+        has grown in place, read only the new lines. Otherwise, if either 
+        file was replaced or changed, read them again. Changed tasks are 
+        merged by uid into the :class:`Task` objects already loaded, except 
+        for attributes with changes not yet written by :meth:`write_tasks`. 
+        Return True if any task was added or changed since the last call, 
+        also by the merges that :meth:`write_tasks` and :meth:`compact` do
+        before writing, for example from a :class:`WriteBehind` thread.
+
+        """
+        with self._file_lock(shared=True), self.lock:
+            loaded = len(self.tasks)
+            self._refresh()
+            if stats is not None:
+                stats.add('tasks_loaded', len(self.tasks) - loaded)
+            merged, self._merged = self._merged, False
+            return merged
+
+    def _refresh(self):
+        """Merge external changes; the caller holds the file lock."""
+        base_stat = file_stat(self.filename)
+        journal_stat = file_stat(self.journal_filename)
+        old_stat = self._base_stat
+        if base_stat != old_stat:
+            if (base_stat is None or old_stat is None or 
+                base_stat[0] != old_stat[0] or base_stat[2] <= old_stat[2] or
+                journal_stat is not None):
+                self._reload()
+                return True
+            # Lines appended to the .csv file
+            with open(self.filename) as fh:
+                fh.seek(old_stat[2])
+                lines = [line.strip() for line in fh]
+            self._base_stat = base_stat
+            pending = self._pending_columns()
+            for line in lines:
+                if line:
+                    self._merge(line.split('\t'), pending)
+            return True
+        if journal_stat is None:
+            if self._journal_seen is None:
+                return False
+            self._reload()
+            return True
+        inode, length = self._journal_seen or (journal_stat[0], 0)
+        if journal_stat[0] != inode or journal_stat[2] < length:
+            self._reload()
+            return True
+        if journal_stat[2] == length:
+            return False
+        additions, changes, self._journal_seen = self._read_journal(length)
+        pending = self._pending_columns()
+        for uid, fields in additions.iteritems():
+            if uid in changes:
+                apply_changes(fields, changes.pop(uid))
+            self._merge(fields, pending)
+        for uid, columns in changes.iteritems():
+            task = self.uids.get(uid)
+            if task is None:
+                if columns.get(_STATUS) in self.active_statuses:
+                    # A task left out by lazy mode became active
+                    self._reload()
+                    return True
+                continue
+            fields = task_fields(task)
+            apply_changes(fields, columns)
+            self._merge(fields, pending)
+        return True
+
+    def _reload(self):
+        """Read the files again and merge every task by uid."""
+        self._base_stat = file_stat(self.filename)
+        pending = self._pending_columns()
+        with paused_gc():
+            for fields in self._iter_rows(track=True):
+                self._merge(fields, pending)
+
+    def _merge(self, fields, pending):
+        """Merge the fields of a task read from the files.
+
+        :param fields: List of field values, in :data:`FIELDS` order.
+        :param pending: Set of (uid, attribute) tuples of changes not yet
+                        written, which are kept.
+
+        Create the task if it is not loaded, unless lazy mode leaves it out;
+        otherwise, set the attributes that differ.
+
+        """
+        if self._archived:
+            # Added back to the .csv file by another process
+            self._archived.discard(fields[_UID])
+        task = self.uids.get(fields[_UID])
+        if task is None:
+            if self.loaded or fields[_STATUS] in self.active_statuses:
+                task = Task(*fields)
+                self.tasks.append(task)
+                self._index_task(task)
+                self._merged = True
+            return
+        if task_fields(task) == list(fields[:len(FIELDS)]):
+            return
+        fresh = Task(*fields)
+        for attr in FIELDS:
+            value = getattr(fresh, attr)
+            if (getattr(task, attr) != value and 
+                (task.uid, attr) not in pending):
+                self._set_attribute(task, attr, value)
+                self._merged = True
+
+    def _pending_columns(self):
+        """Return the set of (uid, attribute) tuples of queued changes."""
+        pending = set()
+        for record in self._pending:
+            if record[0] == 'add':
+                pending.update((record[1], attr) for attr in FIELDS)
+            elif record[0] == 'status':
+                pending.add((record[1], 'status'))
+            else:
+                pending.add((record[1], record[2]))
+        return pending
+
+    def _file_lock(self, shared=False):
+        """Hold a shared or exclusive lock on the lock file."""
+        return file_lock(self.lock_filename, shared)
+
+    def iter_tasks(self, **kwargs):
+        """Iterate tasks in .csv file that match certain criteria.
+
+        :param \*\*kwargs: A dictionary whose keys are :class:`Task` object
+                         attributes and whose values are lists of desired 
+                         values for each attribute, as in 
+                         :meth:`filter_tasks`.
+
+        Read the file line by line, check the criteria on the split line and
+        create a :class:`Task` object only for lines that match all of them.
+        Journal changes are included; changes not yet written by 
+        :meth:`write_tasks` are not. Archive segments are read afterwards, 
+        unless only :attr:`active_statuses` are asked for. The snapshot cache
+        is neither read nor written, so memory use does not grow with the 
+        size of the file.
+
+        """
+        columns = []
+        for attr, values in kwargs.iteritems():
+            if attr not in FIELDS:
+                return
+            columns.append((FIELDS.index(attr), set(str(v) for v in values)))
+        if self._active_only(kwargs.get('status')):
+            rows = self._iter_rows(cached=False)
+        else:
+            rows = self._iter_rows_and_archive()
+        for fields in rows:
+            for column, values in columns:
+                if column >= len(fields) or fields[column] not in values:
+                    break
+            else:
+                yield Task(*fields)
+
+    def iter_uids(self):
+        """Iterate the uids of the tasks in the .csv file and journal.
+
+        Like :meth:`iter_tasks`, but no :class:`Task` objects are created.
+
+        """
+        for fields in self._iter_rows_and_archive():
+            yield fields[_UID]
+
+    def append_tasks(self, tasks):
+        """Append tasks to the .csv file without reading it.
+
+        :param tasks: Iterable of :class:`Task` objects.
+
+        Write a line for each task at the end of the file while holding the
+        file lock, so that any number of tasks is added in constant memory. 
+        The tasks are not added to :attr:`tasks`; task lists pick them up 
+        with :meth:`refresh`. Return the number of tasks written.
+
+        """
+        written = 0
+        with self._write_lock, self._file_lock():
+            with open(self.filename, "a+") as fh:
+                fh.seek(0, os.SEEK_END)
+                start = fh.tell()
+                if start:
+                    fh.seek(-1, os.SEEK_END)
+                    if fh.read(1) != '\n':
+                        fh.write('\n')
+                for task in tasks:
+                    fh.write('\t'.join(task_fields(task)))
+                    fh.write('\n')
+                    written += 1
+                if self.fsync != 'never':
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                if stats is not None:
+                    stats.add('bytes_written', fh.tell() - start)
+        return written
+
+    def append_statuses(self, uids, status):
+        """Record a status for many tasks without reading them.
+
+        :param uids: Iterable of task uids.
+        :param status: The new status of the tasks.
+
+        Append a status record for each uid to the journal while holding the
+        file lock, in constant memory. Records for uids without a task are
+        ignored when the journal is read. If the journal has grown past its 
+        thresholds, fold it into the .csv file line by line. Return the 
+        number of records written.
+
+        """
+        written = 0
+        uids = iter(uids)
+        finished = False
+        with self._write_lock, self._file_lock():
+            while not finished:
+                finished = True
+                with open(self.journal_filename, "a") as fh:
+                    if stats is not None:
+                        start = os.fstat(fh.fileno()).st_size
+                    for uid in uids:
+                        fh.write('\t'.join(['status', uid, status]))
+                        fh.write('\n')
+                        written += 1
+                        if (written % 10000 == 0 and 
+                            self._journal_full(fh.tell())):
+                            finished = False
+                            break
+                    if self.fsync == 'always':
+                        fh.flush()
+                        os.fsync(fh.fileno())
+                    journal_size = fh.tell()
+                    if stats is not None:
+                        stats.add('bytes_written', journal_size - start)
+                if self._journal_full(journal_size):
+                    self._compact_files()
+        return written
+
+    @instrumented('load_all')
+    def load_all(self):
+        """Read the tasks left out by lazy mode.
+
+        Read the whole file and rebuild :attr:`tasks` in file order, reusing 
+        the :class:`Task` objects already loaded. Tasks added since the file 
+        was last written are kept at the end.
+
+        """
+        with self.lock:
+            if self.loaded:
+                return
+            # Rebuilt by the next query, which is cheaper than inserting 
+            # many tasks one by one
+            self.sorted_indexes = {}
+            uids = self.uids
+            tasks = []
+            with paused_gc():
+                for fields in self._iter_rows():
+                    task = uids.get(fields[_UID])
+                    if task is None:
+                        task = Task(*fields)
+                        self._index_task(task)
+                    tasks.append(task)
+            listed = set(tasks)
+            tasks.extend(task for task in self.tasks if task not in listed)
+            if stats is not None:
+                stats.add('tasks_loaded', len(tasks) - len(self.tasks))
+            self.tasks = tasks
+            self.loaded = True
+
+    @instrumented('load_archive')
+    def load_archive(self):
+        """Read the archived tasks.
+
+        Read the tasks left out by lazy mode first, then each archive 
+        segment, adding the tasks that are not in the .csv file or journal, 
+        whose version takes precedence.
+
+        """
+        with self.lock:
+            if self.archive_loaded:
+                return
+            self.load_all()
+            self.sorted_indexes = {}
+            loaded = len(self.tasks)
+            uids = self.uids
+            with paused_gc():
+                for fields in self._iter_archive():
+                    if fields[_UID] in uids:
+                        continue
+                    task = Task(*fields)
+                    self.tasks.append(task)
+                    self._index_task(task)
+                    self._archived.add(task.uid)
+            if stats is not None:
+                stats.add('tasks_loaded', len(self.tasks) - loaded)
+            self.archive_loaded = True
+
+    def _active_only(self, statuses):
+        """Return True if statuses are all in :attr:`active_statuses`."""
+        return (statuses is not None and 
+                set(statuses) <= set(self.active_statuses))
+
+    def _iter_archive(self):
+        """Yield the fields of each task in the archive segments."""
+        for filename in sorted(glob.glob(self.archive_filename % '*')):
+            for fields in read_segment(filename):
+                yield fields
+
+    def _iter_rows_and_archive(self):
+        """Yield the fields of each task in the files and archive.
+
+        Like :meth:`_iter_rows` without the snapshot cache, followed by the
+        archived tasks that are not in the .csv file or journal. Memory use 
+        grows with the number of tasks in the .csv file and journal only.
+
+        """
+        uids = set()
+        for fields in self._iter_rows(cached=False):
+            uids.add(fields[_UID])
+            yield fields
+        for fields in self._iter_archive():
+            if fields[_UID] not in uids:
+                yield fields
+
+    def _write_archive(self, rows):
+        """Add rows to their archive segments.
+
+        :param rows: List of field lists of finished tasks.
+
+        Each segment a row goes to is read and written again, through a 
+        temporary file, with the rows for the same uids replaced. Unless 
+        :attr:`fsync` is 'never', segments are forced to disk before they 
+        replace the old ones.
+
+        """
+        import gzip
+        months = {}
+        for fields in rows:
+            month = fields[_DATE][:7]
+            if not re.match(r'\d{4}-\d{2}$', month):
+                month = 'undated'
+            months.setdefault(month, []).append(fields)
+        for month, new_rows in sorted(months.iteritems()):
+            filename = self.archive_filename % month
+            segment = OrderedDict()
+            if os.path.exists(filename):
+                for fields in read_segment(filename):
+                    segment[fields[_UID]] = fields
+            for fields in new_rows:
+                segment.pop(fields[_UID], None)
+                segment[fields[_UID]] = fields
+            data = ''.join('\t'.join(fields[:len(FIELDS)]) + '\n' 
+                           for fields in segment.itervalues())
+            tmp_filename = filename + ".tmp"
+            with open(tmp_filename, "wb") as fh:
+                with gzip.GzipFile('', "wb", fileobj=fh) as gz:
+                    gz.write(data)
+                if self.fsync != 'never':
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                if stats is not None:
+                    stats.add('bytes_written', fh.tell())
+            os.rename(tmp_filename, filename)
+
+    def _iter_rows(self, track=False, cached=True):
+        """Yield the fields of each task in the .csv file and journal.
+
+        :param track: If True, remember how much of the journal was read.
+        :param cached: If False, do not use the snapshot cache.
+
+        Take the fields of each line of the .csv file from :meth:`_iter_base`
+        and apply the journal changes for its uid; then yield the tasks added
+        in the journal.
+
+        """
+        additions, changes, journal_seen = self._read_journal()
+        if track:
+            self._journal_seen = journal_seen
+        for fields in self._iter_base(cached):
+            uid = fields[_UID]
+            # The task was added to the journal and then compacted
+            additions.pop(uid, None)
+            if uid in changes:
+                fields = list(fields)
+                apply_changes(fields, changes[uid])
+            yield fields
+        for uid, fields in additions.iteritems():
+            if uid in changes:
+                apply_changes(fields, changes[uid])
+            yield fields
+
+    def _iter_base(self, cached=True):
+        """Yield the fields of each task line in the .csv file.
+
+        :param cached: If False, do not use the snapshot cache.
+
+        If the snapshot cache is valid, yield its rows, which also hold the
+        parsed creation date of each task. Otherwise, split each non-empty 
+        line of the file and, once the whole file has been read, rebuild the
+        cache. On machines with several processors, files of at least 
+        :attr:`parallel_min_bytes` are split by :meth:`_iter_parallel` 
+        instead.
+
+        """
+        if not cached:
+            try:
+                fh = open(self.filename)
+            except IOError:
+                return
+            with fh:
+                for line in fh:
+                    line = line.strip()
+                    if line:
+                        yield line.split('\t')
+            return
+        cache = self._read_cache()
+        if cache is not None:
+            rows, dates = cache
+            for row, date in izip(rows, dates):
+                yield row + (datetime(date) if date else None,)
+            return
+        try:
+            fh = open(self.filename)
+        except IOError:
+            return
+        rows = []
+        digest = hashlib.sha1()
+        with fh:
+            stat = os.fstat(fh.fileno())
+            processes = 0
+            if stat.st_size >= self.parallel_min_bytes:
+                processes = self.parallel_processes or cpu_count()
+            # A single worker would only add the cost of starting it
+            if processes > 1:
+                for fields in self._iter_parallel(fh, stat, processes):
+                    yield fields
+                return
+            for line in fh:
+                digest.update(line)
+                line = line.strip()
+                if not line:
+                    continue
+                fields = line.split('\t')
+                rows.append(fields)
+                yield fields
+        self._write_cache((stat.st_mtime, stat.st_size, digest.hexdigest()), 
+                          rows)
+
+    def _iter_parallel(self, fh, stat, processes):
+        """Split the lines of the .csv file in a pool of processes.
+
+        :param fh: The open .csv file.
+        :param stat: Result of :func:`os.fstat` on the file.
+        :param processes: Number of worker processes.
+
+        Divide the file into byte ranges that start and end at line breaks 
+        and have :func:`parse_range` split each range in a worker process,
+        while this process computes the digest of the file. Yield the fields
+        of each line, with its parsed creation date, in file order, and then
+        rebuild the snapshot cache.
+
+        """
+        # More ranges than processes, so that a slow range holds none up
+        import multiprocessing
+        ranges = line_ranges(fh, stat.st_size, processes * 4)
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.imap(parse_range, [(self.filename, start, end) 
+                                            for start, end in ranges])
+            fh.seek(0)
+            digest = hashlib.sha1()
+            for block in iter(lambda: fh.read(1024 * 1024), ''):
+                digest.update(block)
+            rows = []
+            dates = []
+            for part in parts:
+                part_rows, part_dates = marshal.loads(part)
+                for row, date in izip(part_rows, part_dates):
+                    yield row + (datetime(date) if date else None,)
+                rows.extend(part_rows)
+                dates.extend(part_dates)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        self._write_cache((stat.st_mtime, stat.st_size, digest.hexdigest()), 
+                          rows, dates)
+
+    def _read_cache(self):
+        """Read the snapshot cache.
+
+        The cache is valid if the modification time, size and SHA-1 digest of
+        the .csv file match the ones stored with it. Return a tuple with the
+        list of rows and the list of encoded creation dates, or None if the
+        cache is missing or stale.
+
+        """
+        try:
+            stat = os.stat(self.filename)
+            fh = open(self.cache_filename, "rb")
+        except (OSError, IOError):
+            return None
+        with fh:
+            try:
+                signature = marshal.load(fh)
+                if signature[:2] != (stat.st_mtime, stat.st_size):
+                    return None
+                if signature[2] != file_digest(self.filename):
+                    return None
+                return marshal.loads(fh.read())
+            except (EOFError, ValueError, TypeError):
+                return None
+
+    def _write_cache(self, signature, rows, dates=None):
+        """Write the snapshot cache.
+
+        :param signature: Tuple with modification time, size and SHA-1 digest
+                          of the .csv file.
+        :param rows: List of field lists, one for each line in the file.
+        :param dates: List of the encoded creation dates of rows, if they 
+                      were already encoded by :func:`encode_date`.
+
+        Rows are stored as tuples, with a separate list of parsed creation 
+        dates. Dates are encoded as their pickle state, a short string that
+        :class:`datetime.datetime` decodes much faster than an ISO string.
+        The cache is written with :mod:`marshal`, so that reading it is a 
+        single bulk read. Readers may write it at the same time, each 
+        through its own temporary file; if it cannot be written, the .csv 
+        file is parsed again next time.
+
+        """
+        if dates is None:
+            dates = [encode_date(fields[_DATE]) for fields in rows]
+        try:
+            with replaced_file(self.cache_filename) as fh:
+                marshal.dump(signature, fh)
+                fh.write(marshal.dumps(([tuple(fields) for fields in rows], 
+                                        dates)))
+        except (IOError, OSError):
+            pass
+
+    def _read_journal(self, offset=0):
+        """Read the journal.
+
+        :param offset: Position of the first record to read.
+
+        Records are tab separated lines whose first field is the operation:
+
+        add -- uid, summary, description, date, status and logged_time of a
+               new task.
+
+        update -- uid, attribute name and new value of a task attribute.
+
+        status -- uid and new status of a task.
+
+        Return a tuple with an ordered dictionary mapping the uid of each 
+        added task to its fields, a dictionary mapping uids to dictionaries 
+        of changed field positions and their latest values, and a tuple with
+        the inode of the journal and the position after the last record read
+        (or None if there is no journal). Incomplete lines left by an 
+        interrupted write are ignored.
+
+        """
+        additions = OrderedDict()
+        changes = {}
+        try:
+            fh = open(self.journal_filename)
+        except IOError:
+            return additions, changes, None
+        with fh:
+            inode = os.fstat(fh.fileno()).st_ino
+            fh.seek(offset)
+            for line in iter(fh.readline, ''):
+                if not line.endswith('\n'):
+                    # Interrupted write
+                    break
+                offset += len(line)
+                record = line[:-1].split('\t')
+                if len(record) < 3:
+                    continue
+                op, uid = record[0], record[1]
+                if op == 'add' and len(record) == len(FIELDS) + 1:
+                    additions.setdefault(uid, record[1:])
+                elif op == 'status' and len(record) == 3:
+                    changes.setdefault(uid, {})[_STATUS] = record[2]
+                elif (op == 'update' and len(record) == 4 and 
+                      record[2] in FIELDS):
+                    column = FIELDS.index(record[2])
+                    changes.setdefault(uid, {})[column] = record[3]
+        return additions, changes, (inode, offset)
+
+    def _index_task(self, task):
+        """Add task to :attr:`uids` and to each index in :attr:`indexes`."""
+        self.uids[task.uid] = task
+        for attr, index in self.indexes.iteritems():
+            index.setdefault(getattr(task, attr), set()).add(task)
+        for index in self.sorted_indexes.itervalues():
+            index.add(task)
+        if self.text_index is not None:
+            self.text_index.add(task)
+
+    def _set_attribute(self, task, attr, value):
+        """Set task attribute, moving task to the right index posting."""
+        if attr == 'uid':
+            self.uids.pop(task.uid, None)
+            self.uids[value] = task
+        index = self.indexes.get(attr)
+        if index is not None:
+            old_value = getattr(task, attr)
+            posting = index.get(old_value)
+            if posting is not None:
+                posting.discard(task)
+                if not posting:
+                    del index[old_value]
+            index.setdefault(value, set()).add(task)
+        reindex = (self.text_index is not None and 
+                   attr in TextIndex.attributes)
+        if reindex:
+            self.text_index.remove(task)
+        # Keys of sorted indexes hold the value and the uid
+        resorted = [index for index in self.sorted_indexes.itervalues()
+                    if attr in (index.attr, 'uid')]
+        for index in resorted:
+            index.remove(task, getattr(task, index.attr))
+        setattr(task, attr, value)
+        task.version += 1
+        if reindex:
+            self.text_index.add(task)
+        for index in resorted:
+            index.add(task)
+
+    @instrumented('filter_tasks')
+    def filter_tasks(self, **kwargs):
+        """Return a list of tasks that match certain criteria.
+
+        :param \*\*kwargs: A dictionary whose keys are :class:`Task` object
+                         attributes and whose values are lists of desired 
+                         values for each attribute. For example:
+
+        {status: ['needs-action', 'in-process']}
+
+        Unless only :attr:`active_statuses` are requested, read the tasks 
+        left out by lazy mode and the archived tasks first. For each indexed
+        attribute in \*\*kwargs, join the index postings of the desired 
+        values; intersect those sets, smallest first. Attributes without an
+        index are then checked on the remaining tasks only. Return a list of 
+        tasks that match all criteria.
+
+        """
+        with self.lock:
+            if not self.archive_loaded:
+                if not self._active_only(kwargs.get('status')):
+                    self.load_archive()
+            candidates = []
+            unindexed = []
+            for attr, values in kwargs.iteritems():
+                index = self.indexes.get(attr)
+                if attr == 'uid':
+                    matches = set(self.uids[uid] for uid in values 
+                                  if uid in self.uids)
+                elif index is not None:
+                    matches = set()
+                    for value in values:
+                        matches.update(index.get(value, ()))
+                else:
+                    unindexed.append((attr, values))
+                    continue
+                candidates.append(matches)
+            if candidates:
+                candidates.sort(key=len)
+                tasks = candidates[0]
+                for matches in candidates[1:]:
+                    if not tasks:
+                        break
+                    tasks = tasks.intersection(matches)
+            else:
+                tasks = self.tasks
+            for attr, values in unindexed:
+                tasks = [task for task in tasks if hasattr(task, attr) and 
+                         getattr(task, attr) in values]
+            return list(tasks)
+        
+    @instrumented('query')
+    def query(self, query):
+        """Return a list of the tasks that match a :class:`Query`.
+
+        Unless the query can only match :attr:`active_statuses`, read the 
+        tasks left out by lazy mode and the archived tasks first. The 
+        planner takes the candidate tasks from the indexes: hash indexes for
+        :class:`Equal` conditions, :attr:`sorted_indexes` for 
+        :class:`Range` and :class:`Prefix` ones, intersected for 
+        :class:`And` and joined for :class:`Or`. The compiled query is then
+        checked on the candidates only, or on all tasks if no index applies.
+        The tasks are returned in no particular order.
+
+        """
+        with self.lock:
+            if not self.archive_loaded:
+                if not self._active_only(query.statuses()):
+                    self.load_archive()
+            candidates = self._plan(query)
+            if candidates is None:
+                candidates = self.tasks
+            predicate = query.predicate
+            return [task for task in candidates if predicate(task)]
+
+    def _plan(self, query):
+        """Return a set of tasks that includes those matching query.
+
+        Return None if no index narrows the query down.
+
+        """
+        if isinstance(query, Equal):
+            if query.attr == 'uid':
+                return set(self.uids[uid] for uid in query.values 
+                           if uid in self.uids)
+            index = self.indexes.get(query.attr)
+            if index is None:
+                return None
+            tasks = set()
+            for value in query.values:
+                tasks.update(index.get(value, ()))
+            return tasks
+        if isinstance(query, (Range, Prefix)):
+            if query.attr not in self.sorted_attributes:
+                return None
+            # Logged times are sorted as numbers, so the times whose digits
+            # start with a prefix are not next to each other
+            if isinstance(query, Prefix) and query.attr == 'logged_time':
+                return None
+            index = self.sorted_indexes.get(query.attr)
+            if index is None:
+                index = SortedIndex(query.attr, self.tasks)
+                self.sorted_indexes[query.attr] = index
+            if isinstance(query, Range):
+                return set(index.range(query.low, query.high))
+            return set(index.prefix(query.prefix))
+        if isinstance(query, And):
+            plans = [plan for plan in map(self._plan, query.queries) 
+                     if plan is not None]
+            if not plans:
+                return None
+            plans.sort(key=len)
+            tasks = plans[0]
+            for plan in plans[1:]:
+                if not tasks:
+                    break
+                tasks = tasks.intersection(plan)
+            return tasks
+        if isinstance(query, Or):
+            plans = map(self._plan, query.queries)
+            if None in plans:
+                return None
+            return set().union(*plans)
+        return None
+
+    @instrumented('search_tasks')
+    def search_tasks(self, query):
+        """Return the tasks that contain the words of a query.
+
+        :param query: A string of words; each must be the start of a word in
+                      the summary or description of the task.
+
+        On the first search, read the text index from its file or build it
+        from the loaded tasks; it is kept up to date afterwards. In lazy mode,
+        only the loaded tasks are searched. Return a list of tasks in no 
+        particular order.
+
+        """
+        with self.lock:
+            if self.text_index is None:
+                self.text_index = self._read_text_index()
+            if self.text_index is None:
+                self.text_index = TextIndex(self.tasks)
+            return list(self.text_index.search(query))
+
+    def save_text_index(self):
+        """Write the text index to its file.
+
+        The index is saved along with the modification time and size of the 
+        .csv file and journal, and with the tasks as positions in 
+        :attr:`tasks`. Nothing is saved if no search built the index, or if
+        there are changes not yet written by :meth:`write_tasks`, which the 
+        index includes but the files do not.
+
+        """
+        with self._write_lock, self.lock:
+            if self.text_index is None or self._pending:
+                return
+            uids = [task.uid for task in self.tasks]
+            positions = dict((task, i) for i, task in enumerate(self.tasks))
+            words, starts, flat = self.text_index.dump(positions)
+            with replaced_file(self.text_index_filename) as fh:
+                marshal.dump((self._signature(), 
+                              (self.loaded, self.archive_loaded)), fh)
+                fh.write(marshal.dumps((uids, words, starts.tostring(), 
+                                        flat.tostring())))
+
+    def _read_text_index(self):
+        """Read the text index saved by :meth:`save_text_index`.
+
+        The saved index is valid if the .csv file and journal have not 
+        changed since, and it covers the tasks left out by lazy mode and the
+        archived tasks when those are loaded. Return a :class:`TextIndex` of
+        the loaded tasks, or None.
+
+        """
+        try:
+            fh = open(self.text_index_filename, "rb")
+        except IOError:
+            return None
+        with fh:
+            try:
+                signature, (loaded, archive_loaded) = marshal.load(fh)
+                if (signature != self._signature() or 
+                    (self.loaded and not loaded) or 
+                    (self.archive_loaded and not archive_loaded)):
+                    return None
+                uids, words, starts, flat = marshal.loads(fh.read())
+            except (EOFError, ValueError, TypeError):
+                return None
+        # Tasks left out by lazy mode are None, and skipped by TextIndex
+        tasks = [self.uids.get(uid) for uid in uids]
+        return TextIndex.load(words, array('i', starts), array('i', flat), 
+                              tasks)
+
+    def _signature(self):
+        """Return the modification time and size of the .csv and journal."""
+        signature = []
+        for filename in [self.filename, self.journal_filename]:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                signature.append(None)
+            else:
+                signature.append((stat.st_mtime, stat.st_size))
+        return tuple(signature)
+
+    @instrumented('write_tasks')
+    def write_tasks(self):
+        """Write tasks to .csv file.
+        
+        In journal mode, append queued change records to the journal and
+        compact it if it has grown past its thresholds. Otherwise, rewrite the
+        whole file with :meth:`compact`. Changes made by other processes are
+        merged first, under the file lock. Only merging and taking the queued
+        records hold :attr:`lock`; the file is written without it.
+
+        """
+        if not self.journal:
+            self.compact()
+            return
+        with self._write_lock:
+            if not self._pending:
+                return
+            with self._file_lock():
+                with self.lock:
+                    self._refresh()
+                    pending, self._pending = self._pending, []
+                with open(self.journal_filename, "a") as fh:
+                    if stats is not None:
+                        start = os.fstat(fh.fileno()).st_size
+                    for record in pending:
+                        fh.write('\t'.join(record))
+                        fh.write('\n')
+                    journal_size = fh.tell()
+                    if stats is not None:
+                        stats.add('bytes_written', journal_size - start)
+                    if self.fsync == 'always':
+                        fh.flush()
+                        os.fsync(fh.fileno())
+                    self._journal_seen = (os.fstat(fh.fileno()).st_ino, 
+                                          journal_size)
+        if self._journal_full(journal_size):
+            self.compact()
+
+    def _compact_files(self):
+        """Fold the journal into the .csv file without loading the tasks.
+
+        Stream the tasks, with journal changes applied, to a temporary file 
+        that replaces the .csv file, and remove the journal. Memory use grows
+        with the size of the journal only. The caller holds the file lock.
+
+        """
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as fh:
+            for fields in self._iter_rows(cached=False):
+                fh.write('\t'.join(fields[:len(FIELDS)]))
+                fh.write('\n')
+            if self.fsync != 'never':
+                fh.flush()
+                os.fsync(fh.fileno())
+            if stats is not None:
+                stats.add('bytes_written', fh.tell())
+        os.rename(tmp_filename, self.filename)
+        os.remove(self.journal_filename)
+
+    def _journal_full(self, journal_size):
+        """Return True if the journal should be compacted."""
+        if journal_size > self.journal_max_bytes:
+            return True
+        try:
+            base_size = os.path.getsize(self.filename)
+        except OSError:
+            base_size = 0
+        return (journal_size > self.journal_min_bytes and 
+                journal_size > base_size * self.journal_max_ratio)
+
+    @instrumented('compact')
+    def compact(self):
+        """Fold the journal back into the .csv file.
+
+        Take the fields of each task in :attr:`tasks` and write them to a
+        temporary file, which then atomically replaces the tasks.csv file, and
+        update the snapshot cache. Remove the journal afterwards, since the
+        new file already includes all its changes. In lazy mode, read the
+        remaining tasks first, so they are not lost. Unless :attr:`fsync` is
+        'never', the new file is forced to disk before it replaces the old
+        one. Changes made by other processes are merged first, under the file
+        lock.
+
+        In :attr:`archive` mode, finished tasks are written to their archive
+        segments instead, before the .csv file is replaced; until then, the 
+        .csv file still holds them. Archived tasks are never written to the 
+        .csv file again unless they change.
+
+        """
+        with self._write_lock, self._file_lock():
+            with self.lock:
+                self._refresh()
+                self.load_all()
+                rows = []
+                finished = []
+                active_statuses = self.active_statuses
+                for task in self.tasks:
+                    if task.uid in self._archived:
+                        continue
+                    if self.archive and task.status not in active_statuses:
+                        finished.append(task_fields(task))
+                    else:
+                        rows.append(task_fields(task))
+                self._pending = []
+                # Changes made from now on add the tasks back to the file
+                self._archived.update(fields[_UID] for fields in finished)
+            try:
+                if finished:
+                    self._write_archive(finished)
+                self._write_base(rows)
+            except:
+                with self.lock:
+                    self._archived.difference_update(
+                        fields[_UID] for fields in finished)
+                raise
+
+    def _write_base(self, rows):
+        """Replace the .csv file with rows and remove the journal.
+
+        :param rows: List of field lists.
+
+        The caller holds the file lock.
+
+        """
+        tmp_filename = self.filename + ".tmp"
+        digest = hashlib.sha1()
+        with open(tmp_filename, "w") as fh:
+            for fields in rows:
+                line = '\t'.join(fields) + '\n'
+                fh.write(line)
+                digest.update(line)
+            if self.fsync != 'never':
+                fh.flush()
+                os.fsync(fh.fileno())
+        os.rename(tmp_filename, self.filename)
+        stat = os.stat(self.filename)
+        if stats is not None:
+            stats.add('bytes_written', stat.st_size)
+        self._write_cache(
+            (stat.st_mtime, stat.st_size, digest.hexdigest()), rows)
+        try:
+            os.remove(self.journal_filename)
+        except OSError:
+            pass
+        self._base_stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        self._journal_seen = None
+
+
+class TaskListMmap(object):
+
+    """
+    Access single tasks in the .csv file without parsing the whole file.
+
+    The file is memory-mapped, and an index from each task uid to the offset
+    and length of its line is kept in a sidecar file, so that tasks can be
+    fetched and updated by uid without holding the task list in memory.
+
+    Lines written by this class end with :attr:`line_slack` spaces, which
+    other readers strip. Changed fields can use that room, so most updates 
+    overwrite the line in place; otherwise the old line is blanked and the 
+    task is appended to the end of the file.
+
+    Data attributes:
+
+    .. attribute:: offsets
+
+        A dictionary mapping each task uid to a tuple with the byte offset of
+        its line in the .csv file and the line length, without the newline.
+
+    .. attribute:: filename
+
+        The .csv file; the index file is named after it.
+
+    Public functions:
+
+    get_task -- Return the task with a given uid.
+
+    add_task -- Append a Task object to the .csv file.
+
+    update_task -- Change task attributes and write the task line.
+
+    write_tasks -- Does nothing; changes are written as they are made.
+
+    close -- Unmap the .csv file.
+
+    """
+
+    filename = TaskListCSV.filename
+    index_filename = "tasks.csv.idx"
+    line_slack = 8
+    # The index starts with the size and modification time of the .csv file
+    # it describes; it is fixed width, so it can be rewritten in place
+    _index_header = "%020d\t%020.6f\n"
+
+    def __init__(self, filename=None):
+        """Map the .csv file and read or build its index.
+
+        :param filename: The .csv file, if not :attr:`filename`.
+
+        If a journal exists, it is compacted first, so that the file holds
+        the current version of every task.
+
+        """
+        if filename is not None and filename != self.filename:
+            self.filename = filename
+            self.index_filename = filename + ".idx"
+        csv_list = TaskListCSV(journal=True, read=False, 
+                               filename=self.filename)
+        # Shared with TaskListCSV, whose writers replace the file
+        self.lock_filename = csv_list.lock_filename
+        if os.path.exists(csv_list.journal_filename):
+            csv_list.read_tasks()
+            csv_list.compact()
+        self.mm = None
+        self.offsets = {}
+        # Inode, modification time and size of the .csv file when offsets
+        # were last brought up to date
+        self._stat = None
+        # True if offsets were built under a shared lock and the index file
+        # still describes an older version of the .csv file
+        self._index_outdated = False
+        with file_lock(self.lock_filename):
+            self._map()
+            if not self._read_index():
+                self._build_index()
+
+    def get_task(self, uid):
+        """Return the task with a given uid, or None if there is none.
+
+        :param uid: Unique identifier of the task.
+
+        Look up the position of the task line in :attr:`offsets` and create a
+        :class:`Task` object from that line only. The line is read under a 
+        shared file lock, after reading the index again if another process
+        changed the file.
+
+        """
+        with file_lock(self.lock_filename, shared=True):
+            self._refresh_index(shared=True)
+            try:
+                offset, length = self.offsets[uid]
+            except KeyError:
+                return None
+            line = self.mm[offset:offset + length].strip()
+        if not line:
+            return None
+        return Task(*line.split('\t'))
+
+    def add_task(self, task):
+        """Append a Task object to the .csv file and return it."""
+        with file_lock(self.lock_filename):
+            self._refresh_index()
+            self._append([task])
+        return task
+
+    def update_task(self, task, **kwargs):
+        """Change task attributes and write the task line.
+
+        :param task: :class:`Task` object to change, as returned by 
+                     :meth:`get_task`.
+        :param \*\*kwargs: A dictionary whose keys are :class:`Task` object
+                         attributes and whose values are the new values for
+                         each attribute.
+
+        If the new line fits in the old one, overwrite it in place. Otherwise,
+        blank the old line and append the task to the end of the file. The
+        file is written under the lock file, after reading the index again if
+        another process changed the file. Return task.
+
+        """
+        uid = task.uid
+        for attr, value in kwargs.iteritems():
+            setattr(task, attr, value)
+        task.version += 1
+        with file_lock(self.lock_filename):
+            self._refresh_index()
+            offset, length = self.offsets[uid]
+            line = '\t'.join(task_fields(task))
+            if len(line) <= length and task.uid == uid:
+                self._write_at(offset, line.ljust(length))
+                self._write_index([])
+            else:
+                # Blank lines are skipped by readers and dropped by 
+                # compaction
+                self._write_at(offset, ' ' * length)
+                del self.offsets[uid]
+                self._append([task])
+        return task
+
+    @instrumented('write_tasks')
+    def write_tasks(self):
+        """Does nothing; changes are written as they are made."""
+        pass
+
+    def close(self):
+        """Unmap the .csv file."""
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def _map(self):
+        """Map the .csv file into memory, replacing any previous map."""
+        self.close()
+        try:
+            fh = open(self.filename, "rb")
+        except IOError:
+            return
+        with fh:
+            if os.fstat(fh.fileno()).st_size:
+                self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _refresh_index(self, shared=False):
+        """Map the .csv file and read its index again if it changed.
+
+        :param shared: True if the caller holds the file lock shared; an 
+                       index that has to be built again is then only kept 
+                       in memory, since other readers may be reading it.
+
+        Other processes overwrite and blank lines in place, append lines and,
+        when compacting, replace the file, moving lines; each changes the 
+        inode, modification time or size recorded when :attr:`offsets` was
+        last brought up to date. The caller holds the file lock.
+
+        """
+        if file_stat(self.filename) == self._stat:
+            return
+        self._map()
+        if not self._read_index():
+            self._build_index(write=not shared)
+
+    def _write_at(self, offset, data):
+        """Overwrite the .csv file at offset with data."""
+        with open(self.filename, "r+b") as fh:
+            fh.seek(offset)
+            fh.write(data)
+
+    def _append(self, tasks):
+        """Append lines for tasks to the .csv file and to the index."""
+        slack = ' ' * self.line_slack
+        entries = []
+        with open(self.filename, "ab") as fh:
+            fh.seek(0, os.SEEK_END)
+            offset = fh.tell()
+            if self.mm is not None and self.mm[-1:] != '\n':
+                fh.write('\n')
+                offset += 1
+            for task in tasks:
+                line = '\t'.join(task_fields(task)) + slack
+                fh.write(line)
+                fh.write('\n')
+                entries.append((task.uid, offset, len(line)))
+                offset += len(line) + 1
+        for uid, offset, length in entries:
+            self.offsets[uid] = (offset, length)
+        self._map()
+        self._write_index(entries)
+
+    def _signature(self):
+        """Return the index header for the current .csv file."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return self._index_header % (0, 0)
+        return self._index_header % (stat.st_size, stat.st_mtime)
+
+    def _read_index(self):
+        """Read the index file into :attr:`offsets`.
+
+        Entries are tab separated lines with uid, offset and length; later 
+        entries for the same uid replace earlier ones. Return False if the
+        index is missing or does not describe the current .csv file.
+
+        """
+        try:
+            fh = open(self.index_filename, "rb")
+        except IOError:
+            return False
+        with fh:
+            if fh.readline() != self._signature():
+                return False
+            offsets = {}
+            for line in fh:
+                if not line.endswith('\n'):
+                    return False
+                uid, offset, length = line[:-1].split('\t')
+                offsets[uid] = (int(offset), int(length))
+        self.offsets = offsets
+        self._stat = file_stat(self.filename)
+        return True
+
+    def _build_index(self, write=True):
+        """Scan the mapped .csv file for line offsets and write the index.
+
+        :param write: False to keep the offsets in memory only.
+
+        """
+        self.offsets = offsets = {}
+        self._stat = file_stat(self.filename)
+        self._index_outdated = not write
+        mm = self.mm
+        size = mm.size() if mm is not None else 0
+        start = 0
+        while start < size:
+            end = mm.find('\n', start)
+            if end == -1:
+                end = size
+            tab = mm.find('\t', start, end)
+            uid = mm[start:tab if tab != -1 else end].strip()
+            if uid:
+                offsets[uid] = (start, end - start)
+            start = end + 1
+        if not write:
+            return
+        with open(self.index_filename, "wb") as fh:
+            fh.write(self._signature())
+            for uid, (offset, length) in offsets.iteritems():
+                fh.write("%s\t%d\t%d\n" % (uid, offset, length))
+
+    def _write_index(self, entries):
+        """Append entries to the index and update its header.
+
+        :param entries: List of (uid, offset, length) tuples.
+
+        If the index file is missing or outdated, build it again instead.
+
+        """
+        if self._index_outdated or not os.path.exists(self.index_filename):
+            self._build_index()
+            return
+        with open(self.index_filename, "r+b") as fh:
+            fh.seek(0, os.SEEK_END)
+            for entry in entries:
+                fh.write("%s\t%d\t%d\n" % entry)
+            fh.seek(0)
+            fh.write(self._signature())
+        self._stat = file_stat(self.filename)
+
+
+class TaskListSQLite(object):
+
+    """
+    Manage task list with a SQLite database backend.
+
+    Offers the same interface as :class:`TaskListCSV`. Each change is a 
+    single row statement, committed by :meth:`write_tasks`, and 
+    :meth:`filter_tasks` is answered by indexed SQL queries.
+
+    Data attributes:
+
+    .. attribute:: tasks
+
+        A list of the Task objects loaded so far.
+
+    .. attribute:: uids
+
+        A dictionary mapping each loaded task uid to its :class:`Task` object.
+
+    .. attribute:: loaded
+
+        False while a lazy task list holds only tasks whose status is one of
+        :attr:`active_statuses`; True once all tasks have been read.
+
+    .. attribute:: connection
+
+        The :class:`sqlite3.Connection` to the database.
+
+    Public functions:
+
+    add_task -- Add a Task object to the task list.
+
+    add_tasks -- Add many Task objects to the task list and write them at once.
+
+    update_task -- Change task attributes and record the change.
+
+    filter_tasks -- Return a list of tasks that match certain criteria.
+
+    query -- Return a list of the tasks that match a :class:`Query`.
+
+    search_tasks -- Return the tasks that contain the words of a query.
+
+    read_tasks -- Read tasks from the database.
+
+    refresh -- Merge changes committed to the database by other processes.
+
+    load_all -- Read the tasks left out by lazy mode.
+
+    write_tasks -- Commit changes to the database.
+
+    """
+
+    filename = "tasks.db"
+    active_statuses = TaskListCSV.active_statuses
+    # The uid primary key is indexed by SQLite itself
+    _schema = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            uid TEXT PRIMARY KEY,
+            summary TEXT,
+            description TEXT,
+            date TEXT,
+            status TEXT,
+            logged_time INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+        CREATE INDEX IF NOT EXISTS tasks_date ON tasks (date);
+        CREATE INDEX IF NOT EXISTS tasks_logged_time ON tasks (logged_time);
+        """
+    _select = "SELECT %s FROM tasks" % ', '.join(FIELDS)
+    _insert = ("INSERT OR REPLACE INTO tasks (%s) VALUES (?, ?, ?, ?, ?, ?)" % 
+               ', '.join(FIELDS))
+
+    def __init__(self, lazy=False, filename=None):
+        """Open the database and read tasks from it.
+
+        :param lazy: If True, read only tasks with an active status; other 
+                     tasks are read when :meth:`filter_tasks` asks for them.
+        :param filename: The database file, if not :attr:`filename`.
+
+        """
+        if filename is not None:
+            self.filename = filename
+        self.tasks = []
+        self.uids = {}
+        self.loaded = not lazy
+        self.text_index = None
+        import sqlite3
+        self.connection = sqlite3.connect(self.filename)
+        # Return byte strings, like the .csv backend
+        self.connection.text_factory = str
+        self.connection.executescript(self._schema)
+        # Changes when other connections commit
+        self._data_version = self._get_data_version()
+        self.read_tasks()
+
+    def add_task(self, task):
+        """Add a Task object to the task list.
+
+        Insert task into the database, append it to :attr:`tasks` and return 
+        it.
+
+        """
+        self.connection.execute(self._insert, task_values(task))
+        self._load(task)
+        return task
+
+    def add_tasks(self, tasks):
+        """Add many Task objects to the task list and write them at once.
+
+        :param tasks: Iterable of Task objects.
+
+        Insert all tasks with a single statement and commit. Return the list 
+        of added tasks.
+
+        """
+        with paused_gc():
+            added = [self._load(task) for task in tasks]
+        self.connection.executemany(self._insert, 
+                                    (task_values(task) for task in added))
+        self.write_tasks()
+        return added
+
+    def update_task(self, task, **kwargs):
+        """Change task attributes and record the change.
+
+        :param task: :class:`Task` object to change.
+        :param \*\*kwargs: A dictionary whose keys are :class:`Task` object
+                         attributes and whose values are the new values for
+                         each attribute.
+
+        Set each attribute and update the task row. Return task.
+
+        """
+        uid = task.uid
+        columns = []
+        reindex = (self.text_index is not None and 
+                   not TextIndex.attributes.isdisjoint(kwargs))
+        if reindex:
+            self.text_index.remove(task)
+        for attr, value in kwargs.iteritems():
+            setattr(task, attr, value)
+            if attr in FIELDS:
+                columns.append(attr)
+        task.version += 1
+        if reindex:
+            self.text_index.add(task)
+        if task.uid != uid:
+            self.uids.pop(uid, None)
+            self.uids[task.uid] = task
+        if columns:
+            assignments = ', '.join("%s = ?" % column for column in columns)
+            values = [getattr(task, column) for column in columns]
+            self.connection.execute(
+                "UPDATE tasks SET %s WHERE uid = ?" % assignments, 
+                values + [uid])
+        return task
+
+    @instrumented('read_tasks')
+    def read_tasks(self):
+        """Read tasks from the database.
+
+        Create a :class:`Task` object for each row and append it to 
+        :attr:`tasks`. In lazy mode, read only rows whose status is one of 
+        :attr:`active_statuses`.
+
+        """
+        if self.loaded:
+            self.filter_tasks()
+        else:
+            self.filter_tasks(status=self.active_statuses)
+
+    @instrumented('refresh')
+    def refresh(self):
+        """Merge changes committed to the database by other processes.
+
+        If another connection committed since the last call, read the rows
+        again and update the loaded :class:`Task` objects, loading new tasks
+        unless lazy mode leaves them out. Return True if anything was 
+        committed.
+
+        """
+        data_version = self._get_data_version()
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        text_index = self.text_index
+        loaded = len(self.tasks)
+        with paused_gc():
+            for row in self.connection.execute(self._select + 
+                                               " ORDER BY rowid"):
+                task = self.uids.get(row[0])
+                if task is None:
+                    if self.loaded or row[_STATUS] in self.active_statuses:
+                        self._load(Task(*row))
+                    continue
+                changes = [(attr, value) for attr, value in izip(FIELDS, row)
+                           if getattr(task, attr) != value]
+                if not changes:
+                    continue
+                if text_index is not None:
+                    text_index.remove(task)
+                for attr, value in changes:
+                    setattr(task, attr, value)
+                task.version += 1
+                if text_index is not None:
+                    text_index.add(task)
+        if stats is not None:
+            stats.add('tasks_loaded', len(self.tasks) - loaded)
+        return True
+
+    @instrumented('load_all')
+    def load_all(self):
+        """Read the tasks left out by lazy mode."""
+        if not self.loaded:
+            self.filter_tasks()
+            self.loaded = True
+
+    @instrumented('filter_tasks')
+    def filter_tasks(self, **kwargs):
+        """Return a list of tasks that match certain criteria.
+
+        :param \*\*kwargs: A dictionary whose keys are :class:`Task` object
+                         attributes and whose values are lists of desired 
+                         values for each attribute. For example:
+
+        {status: ['needs-action', 'in-process']}
+
+        Query the database for rows that match all criteria, reusing the 
+        :class:`Task` objects already loaded and loading the others.
+
+        """
+        clauses = []
+        params = []
+        for attr, values in kwargs.iteritems():
+            values = list(values)
+            if attr not in FIELDS or not values:
+                return []
+            placeholders = ', '.join('?' * len(values))
+            clauses.append("%s IN (%s)" % (attr, placeholders))
+            params.extend(values)
+        return self._select_tasks(" AND ".join(clauses), params)
+
+    @instrumented('query')
+    def query(self, query):
+        """Return a list of the tasks that match a :class:`Query`.
+
+        The query is translated to SQL, so that SQLite plans it with its own
+        indexes.
+
+        """
+        return self._select_tasks(*query.sql())
+
+    def _select_tasks(self, condition, params):
+        """Return the tasks of the rows that match a SQL condition.
+
+        :param condition: SQL condition, or an empty string for all rows.
+        :param params: List of parameters of the condition.
+
+        Reuse the :class:`Task` objects already loaded and load the others.
+
+        """
+        query = self._select
+        if condition:
+            query += " WHERE " + condition
+        tasks = []
+        uids = self.uids
+        loaded = len(self.tasks)
+        with paused_gc():
+            for row in self.connection.execute(query + " ORDER BY rowid", 
+                                               params):
+                task = uids.get(row[0])
+                if task is None:
+                    task = self._load(Task(*row))
+                tasks.append(task)
+        if stats is not None:
+            stats.add('tasks_loaded', len(self.tasks) - loaded)
+        return tasks
+
+    @instrumented('search_tasks')
+    def search_tasks(self, query):
+        """Return the tasks that contain the words of a query.
+
+        Like :meth:`TaskListCSV.search_tasks`, but the text index is built 
+        from the loaded tasks on the first search and not saved.
+
+        """
+        if self.text_index is None:
+            self.text_index = TextIndex(self.tasks)
+        return list(self.text_index.search(query))
+
+    @instrumented('write_tasks')
+    def write_tasks(self):
+        """Commit changes to the database."""
+        self.connection.commit()
+
+    def _get_data_version(self):
+        """Return the data version of the database connection."""
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def _load(self, task):
+        """Append task to :attr:`tasks` and :attr:`uids`; return it."""
+        if task.uid not in self.uids:
+            self.tasks.append(task)
+            if self.text_index is not None:
+                self.text_index.add(task)
+        self.uids[task.uid] = task
+        return task
+
+
+def migrate_csv_to_sqlite(csv_filename=None, filename=None):
+    """Copy the tasks in the .csv file into the SQLite database.
+
+    :param csv_filename: The .csv file, if not :attr:`TaskListCSV.filename`.
+    :param filename: The database, if not :attr:`TaskListSQLite.filename`.
+
+    Stream tasks from the .csv file, with journal changes applied, and insert
+    them in a single transaction, replacing tasks with the same uid. Return a 
+    :class:`TaskListSQLite` object.
+
+    """
+    csv_list = TaskListCSV(read=False, filename=csv_filename)
+    task_list = TaskListSQLite(lazy=True, filename=filename)
+    with task_list.connection:
+        task_list.connection.executemany(
+            task_list._insert, 
+            (task_values(task) for task in csv_list.iter_tasks()))
+    task_list.connection.close()
+    return TaskListSQLite(lazy=True, filename=filename)
+
+
+class TaskListRegistry(object):
+
+    """
+    Open task lists by name on demand and keep the recently used ones.
+
+    Lists are named after their files without the extension: the default 
+    list, 'tasks', is kept in tasks.csv, and a name may include a directory.
+    They are opened by a function given to the registry and kept in least
+    recently used order. When the memory taken by their tasks, as estimated
+    by :func:`task_list_memory`, exceeds :attr:`memory_budget`, the least 
+    recently used lists are closed until the rest fit, so that going back 
+    to a recently used list reads nothing.
+
+    Data attributes:
+
+    .. attribute:: lists
+
+        An ordered dictionary mapping the names of the open lists to the 
+        lists, least recently used first.
+
+    .. attribute:: memory_budget
+
+        Bytes of memory the tasks of the open lists may take.
+
+    .. attribute:: pinned
+
+        A set of the names of lists that are never closed to meet the 
+        budget, for example because their tasks are being timed. The most
+        recently used list is not closed either.
+
+    Public functions:
+
+    get -- Return a task list, opening it if needed.
+
+    add -- Add a task list opened elsewhere.
+
+    close -- Close a task list.
+
+    close_all -- Close all task lists.
+
+    trim -- Close least recently used lists until the rest fit the budget.
+
+    """
+
+    def __init__(self, open_list, close_list=None, 
+                 memory_budget=128 * 1024 * 1024):
+        """Start with no open lists.
+
+        :param open_list: Function that returns the task list with a given
+                          name.
+        :param close_list: Function called with the name and the task list 
+                           of each list closed. By default, the changes of
+                           the list are written.
+        :param memory_budget: Bytes of memory the open lists may take.
+
+        """
+        self.lists = OrderedDict()
+        self.memory_budget = memory_budget
+        self.pinned = set()
+        self._open_list = open_list
+        self._close_list = close_list
+
+    def get(self, name):
+        """Return the task list called name, opening it if needed.
+
+        It becomes the most recently used list, and others are closed if 
+        they no longer fit the budget.
+
+        """
+        task_list = self.lists.pop(name, None)
+        if task_list is None:
+            task_list = self._open_list(name)
+        self.lists[name] = task_list
+        self.trim()
+        return task_list
+
+    def add(self, name, task_list):
+        """Add a task list opened elsewhere as the most recently used one."""
+        self.lists.pop(name, None)
+        self.lists[name] = task_list
+        self.trim()
+
+    def close(self, name):
+        """Close the task list called name and forget it."""
+        task_list = self.lists.pop(name)
+        if self._close_list is not None:
+            self._close_list(name, task_list)
+        else:
+            task_list.write_tasks()
+
+    def close_all(self):
+        """Close all task lists, least recently used first."""
+        for name in list(self.lists):
+            self.close(name)
+
+    def trim(self):
+        """Close least recently used lists until the rest fit the budget.
+
+        Pinned lists and the most recently used one are kept even if they 
+        do not fit. Return the names of the closed lists.
+
+        """
+        sizes = dict((name, task_list_memory(task_list)) 
+                     for name, task_list in self.lists.iteritems())
+        total = sum(sizes.itervalues())
+        closed = []
+        for name in list(self.lists)[:-1]:
+            if total <= self.memory_budget:
+                break
+            if name in self.pinned:
+                continue
+            self.close(name)
+            total -= sizes[name]
+            closed.append(name)
+        return closed
+
+
+class TextIndex(object):
+
+    """
+    Find tasks by the words in their summary and description.
+
+    Words are runs of letters and digits, in lower case. Each word maps to 
+    the set of tasks that contain it, and a sorted list of all words answers
+    prefix queries by bisection, so a search costs about the size of its 
+    result rather than the number of tasks.
+
+    An index created by :meth:`load` keeps the saved postings as one array
+    of positions, and turns the postings of a word into a set of tasks the 
+    first time the word is used.
+
+    Data attributes:
+
+    .. attribute:: words
+
+        A sorted list of the indexed words.
+
+    Public functions:
+
+    split -- Return the list of lower case words in a string.
+
+    task_words -- Return the set of words in a task.
+
+    add -- Add the words of a task.
+
+    remove -- Remove the words of a task.
+
+    search -- Return the set of tasks that contain the words of a query.
+
+    dump -- Return the words and the positions of their tasks.
+
+    load -- Create an index from the output of dump.
+
+    """
+
+    # Task attributes whose words are indexed
+    attributes = frozenset(['summary', 'description'])
+    _word_re = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, tasks=()):
+        """Index the words of tasks.
+
+        :param tasks: Iterable of :class:`Task` objects.
+
+        """
+        postings = self._postings = {}
+        for task in tasks:
+            for word in self.task_words(task):
+                posting = postings.get(word)
+                if posting is None:
+                    posting = postings[word] = set()
+                posting.add(task)
+        self.words = sorted(postings)
+        # Saved postings of a loaded index: the words, the start of the 
+        # positions of each word, the positions and the tasks they refer to
+        self._saved_words = []
+        self._saved_starts = array('i')
+        self._saved_positions = array('i')
+        self._saved_tasks = []
+        self._used = set()
+
+    @classmethod
+    def split(cls, text):
+        """Return the list of lower case words in a UTF-8 or unicode string."""
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        return cls._word_re.findall(text.lower())
+
+    @classmethod
+    def task_words(cls, task):
+        """Return the set of words in the summary and description of task."""
+        return set(cls.split(task.summary or '') + 
+                   cls.split(task.description or ''))
+
+    def add(self, task):
+        """Add the words of a task."""
+        for word in self.task_words(task):
+            posting = self._posting(word)
+            if posting is None:
+                posting = self._postings[word] = set()
+                bisect.insort(self.words, word)
+            posting.add(task)
+
+    def remove(self, task):
+        """Remove the words of a task, as they are now."""
+        for word in self.task_words(task):
+            posting = self._posting(word)
+            if posting is None:
+                continue
+            posting.discard(task)
+            if not posting:
+                del self._postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def search(self, query):
+        """Return the set of tasks that contain the words of a query.
+
+        :param query: A string of words.
+
+        A task matches if, for each word in query, it contains a word that 
+        starts with it. The tasks of the rarest word are intersected with the
+        others, smallest first.
+
+        """
+        matches = []
+        words = self.words
+        for prefix in set(self.split(query)):
+            tasks = set()
+            i = bisect.bisect_left(words, prefix)
+            while i < len(words) and words[i].startswith(prefix):
+                tasks.update(self._posting(words[i]))
+                i += 1
+            if not tasks:
+                return set()
+            matches.append(tasks)
+        if not matches:
+            return set()
+        matches.sort(key=len)
+        result = matches[0]
+        for tasks in matches[1:]:
+            result = result.intersection(tasks)
+        return result
+
+    def dump(self, positions):
+        """Return the words and the positions of their tasks.
+
+        :param positions: A dictionary mapping tasks to integers.
+
+        Return a tuple with :attr:`words`, the start of the positions of 
+        each word, and the positions; both are :class:`array.array` objects.
+        The positions of a word end where those of the next word start.
+
+        """
+        starts = array('i')
+        flat = array('i')
+        for word in self.words:
+            starts.append(len(flat))
+            flat.extend(positions[task] for task in self._posting(word)
+                        if task in positions)
+        starts.append(len(flat))
+        return self.words, starts, flat
+
+    @classmethod
+    def load(cls, words, starts, positions, tasks):
+        """Create an index from the output of :meth:`dump`.
+
+        :param words: A sorted list of words.
+        :param starts: An array with the start of the positions of each word.
+        :param positions: An array of positions.
+        :param tasks: A list of the tasks at each position, with None for 
+                      tasks that should be left out.
+
+        """
+        index = cls()
+        index.words = list(words)
+        index._saved_words = words
+        index._saved_starts = starts
+        index._saved_positions = positions
+        index._saved_tasks = tasks
+        return index
+
+    def _posting(self, word):
+        """Return the set of tasks that contain word, or None."""
+        posting = self._postings.get(word)
+        if posting is not None or word in self._used:
+            return posting
+        words = self._saved_words
+        i = bisect.bisect_left(words, word)
+        if i == len(words) or words[i] != word:
+            return None
+        self._used.add(word)
+        tasks = self._saved_tasks
+        starts = self._saved_starts
+        posting = set(tasks[position] for position in 
+                      self._saved_positions[starts[i]:starts[i + 1]])
+        posting.discard(None)
+        self._postings[word] = posting
+        return posting
+
+
+class SortedIndex(object):
+
+    """
+    Keep tasks sorted by an attribute, for range and prefix lookups.
+
+    Tasks are kept in a list ordered by (value, uid) keys, with a parallel
+    list of the keys, so lookups bisect the keys instead of scanning every
+    task. Keys include the uid so that a task is found again when its value
+    changes.
+
+    Data attributes:
+
+    .. attribute:: attr
+
+        Name of the task attribute the tasks are sorted by.
+
+    Public functions:
+
+    add -- Insert a task in order.
+
+    remove -- Remove a task, given the value it was inserted with.
+
+    range -- Return the tasks whose value is in a half-open range.
+
+    prefix -- Return the tasks whose value starts with a string.
+
+    """
+
+    def __init__(self, attr, tasks=()):
+        """Sort tasks by the value of attr."""
+        self.attr = attr
+        decorated = sorted(((getattr(task, attr), task.uid), task) 
+                           for task in tasks)
+        self.keys = [key for key, task in decorated]
+        self.tasks = [task for key, task in decorated]
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task):
+        """Insert a task in order."""
+        key = (getattr(task, self.attr), task.uid)
+        index = bisect.bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.tasks.insert(index, task)
+
+    def remove(self, task, value):
+        """Remove a task that was inserted with value."""
+        index = bisect.bisect_left(self.keys, (value, task.uid))
+        if index < len(self.tasks) and self.tasks[index] is task:
+            del self.keys[index]
+            del self.tasks[index]
+
+    def range(self, low=None, high=None):
+        """Return the tasks whose value is at least low and below high.
+
+        A bound of None leaves that side of the range open.
+
+        """
+        start = 0 if low is None else bisect.bisect_left(self.keys, (low,))
+        end = (len(self.keys) if high is None else 
+               bisect.bisect_left(self.keys, (high,)))
+        return self.tasks[start:end]
+
+    def prefix(self, prefix):
+        """Return the tasks whose value starts with prefix."""
+        start = bisect.bisect_left(self.keys, (prefix,))
+        end = start
+        keys = self.keys
+        while (end < len(keys) and isinstance(keys[end][0], basestring) and 
+               keys[end][0].startswith(prefix)):
+            end += 1
+        return self.tasks[start:end]
+
+
+class Query(object):
+
+    """
+    Select tasks by a condition on their attributes.
+
+    Queries are built from :class:`Equal`, :class:`Range` and 
+    :class:`Prefix` conditions, combined with :class:`And`, :class:`Or` and
+    :class:`Not`, and passed to the ``query`` method of a task list. Each 
+    query is compiled once, on first use, into a predicate function. For 
+    example, the open tasks with more than an hour logged::
+
+        And(Equal('status', 'needs-action', 'in-process'),
+            Range('logged_time', low=3601))
+
+    Data attributes:
+
+    .. attribute:: predicate
+
+        A function that takes a :class:`Task` and returns True if it 
+        matches the query.
+
+    Public functions:
+
+    matches -- Return True if a task matches the query.
+
+    statuses -- Return the statuses the query can match, or None.
+
+    sql -- Return the query as a SQL condition and its parameters.
+
+    """
+
+    _predicate = None
+
+    @property
+    def predicate(self):
+        if self._predicate is None:
+            self._predicate = self._compile()
+        return self._predicate
+
+    def matches(self, task):
+        """Return True if task matches the query."""
+        return self.predicate(task)
+
+    def statuses(self):
+        """Return the set of statuses the query can match, or None if any.
+
+        Task lists use it to leave out tasks that cannot match, like the 
+        tasks left out by lazy mode.
+
+        """
+        return None
+
+    def sql(self):
+        """Return a tuple with a SQL condition and a list of parameters."""
+        raise NotImplementedError
+
+    def _compile(self):
+        """Return the predicate function of the query."""
+        raise NotImplementedError
+
+
+class Equal(Query):
+
+    """Select tasks whose attribute is one of some values."""
+
+    def __init__(self, attr, *values):
+        """:param attr: One of :data:`FIELDS`."""
+        if attr not in FIELDS:
+            raise ValueError("Unknown task attribute: %r" % (attr,))
+        self.attr = attr
+        self.values = frozenset(values)
+
+    def statuses(self):
+        return set(self.values) if self.attr == 'status' else None
+
+    def sql(self):
+        if not self.values:
+            return "0", []
+        placeholders = ', '.join('?' * len(self.values))
+        return "%s IN (%s)" % (self.attr, placeholders), list(self.values)
+
+    def _compile(self):
+        get, values = operator.attrgetter(self.attr), self.values
+        return lambda task: get(task) in values
+
+
+class Range(Query):
+
+    """Select tasks whose attribute is at least low and below high.
+
+    Either bound may be None, to leave that side of the range open. Dates 
+    are compared as ISO 8601 strings; for example, the tasks created in the
+    last week are ``Range('date', low=week_ago.isoformat())``.
+
+    """
+
+    def __init__(self, attr, low=None, high=None):
+        """:param attr: One of :data:`FIELDS`."""
+        if attr not in FIELDS:
+            raise ValueError("Unknown task attribute: %r" % (attr,))
+        self.attr = attr
+        self.low = low
+        self.high = high
+
+    def sql(self):
+        clauses = []
+        params = []
+        if self.low is not None:
+            clauses.append("%s >= ?" % self.attr)
+            params.append(self.low)
+        if self.high is not None:
+            clauses.append("%s < ?" % self.attr)
+            params.append(self.high)
+        return " AND ".join(clauses) or "1", params
+
+    def _compile(self):
+        get, low, high = operator.attrgetter(self.attr), self.low, self.high
+        if low is None and high is None:
+            return lambda task: True
+        if high is None:
+            return lambda task: get(task) >= low
+        if low is None:
+            return lambda task: get(task) < high
+        return lambda task: low <= get(task) < high
+
+
+class Prefix(Query):
+
+    """Select tasks whose attribute starts with a string."""
+
+    def __init__(self, attr, prefix):
+        """:param attr: One of :data:`FIELDS`."""
+        if attr not in FIELDS:
+            raise ValueError("Unknown task attribute: %r" % (attr,))
+        self.attr = attr
+        self.prefix = prefix
+
+    def sql(self):
+        length = len(self.prefix.decode('utf-8', 'replace'))
+        return "substr(%s, 1, %d) = ?" % (self.attr, length), [self.prefix]
+
+    def _compile(self):
+        get, prefix = operator.attrgetter(self.attr), self.prefix
+        return lambda task: str(get(task)).startswith(prefix)
+
+
+class And(Query):
+
+    """Select tasks that match all of some queries."""
+
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def statuses(self):
+        statuses = None
+        for query in self.queries:
+            matched = query.statuses()
+            if matched is not None:
+                statuses = matched if statuses is None else statuses & matched
+        return statuses
+
+    def sql(self):
+        if not self.queries:
+            return "1", []
+        clauses, params = combine_sql(self.queries)
+        return " AND ".join(clauses), params
+
+    def _compile(self):
+        predicates = [query.predicate for query in self.queries]
+        if len(predicates) == 1:
+            return predicates[0]
+
+        def predicate(task):
+            for matches in predicates:
+                if not matches(task):
+                    return False
+            return True
+        return predicate
+
+
+class Or(Query):
+
+    """Select tasks that match any of some queries."""
+
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def statuses(self):
+        statuses = set()
+        for query in self.queries:
+            matched = query.statuses()
+            if matched is None:
+                return None
+            statuses |= matched
+        return statuses
+
+    def sql(self):
+        if not self.queries:
+            return "0", []
+        clauses, params = combine_sql(self.queries)
+        return " OR ".join(clauses), params
+
+    def _compile(self):
+        predicates = [query.predicate for query in self.queries]
+        if len(predicates) == 1:
+            return predicates[0]
+
+        def predicate(task):
+            for matches in predicates:
+                if matches(task):
+                    return True
+            return False
+        return predicate
+
+
+class Not(Query):
+
+    """Select tasks that do not match a query."""
+
+    def __init__(self, query):
+        self.query = query
+
+    def sql(self):
+        clause, params = self.query.sql()
+        return "NOT (%s)" % clause, params
+
+    def _compile(self):
+        matches = self.query.predicate
+        return lambda task: not matches(task)
+
 
-Task -- Defines task properties.
-"""
+def combine_sql(queries):
+    """Return the parenthesized SQL conditions of queries and their params."""
+    clauses = []
+    params = []
+    for query in queries:
+        clause, query_params = query.sql()
+        clauses.append("(%s)" % clause)
+        params.extend(query_params)
+    return clauses, params
 
-import socket
-from datetime import datetime
 
-class TaskListCSV(object):
+class WriteBehind(object):
 
     """
-    Manage task list with a .csv file backend.
+    Write a task list from a background thread.
+
+    Callers ask for a write with :meth:`schedule`, which returns at once. The
+    writer thread waits :attr:`delay` seconds for more requests, so that a 
+    burst of changes is written by a single call to ``write_tasks``. The task
+    list must be safe to change while it is written, as :class:`TaskListCSV` 
+    is. With a delay of None, no thread is started and :meth:`schedule` 
+    writes right away, which suits task lists that can only be used from the
+    thread that opened them, like :class:`TaskListSQLite`.
 
     Data attributes:
 
-    .. attribute:: tasks
+    .. attribute:: delay
 
-        A list of Task objects.
+        Seconds to wait for more changes before writing.
+
+    .. attribute:: error
+
+        The last exception raised by a background write, or None.
 
     Public functions:
 
-    add_task -- Add a Task object to the task list.
+    schedule -- Ask for the task list to be written.
 
-    filter_tasks -- Return a list of tasks that match certain criteria.
+    flush -- Write pending changes now and wait for the write to finish.
 
-    read_tasks -- Read tasks from .csv file.
+    close -- Write pending changes and stop the writer thread.
 
-    write_tasks -- Write tasks to .csv file.
+    """
+
+    def __init__(self, task_list, delay=0.5):
+        """Start the writer thread.
+
+        :param task_list: Task list with a ``write_tasks`` method.
+        :param delay: Seconds to wait for more changes, or None to write 
+                      synchronously.
+
+        """
+        self.task_list = task_list
+        self.delay = delay
+        self.error = None
+        self._requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        # Set by close to cut the delay short
+        self._closing = threading.Event()
+        self._thread = None
+        if delay is not None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def schedule(self):
+        """Ask for the task list to be written."""
+        if self._thread is None:
+            self.task_list.write_tasks()
+            return
+        with self._condition:
+            self._requested = True
+            self._condition.notify()
+
+    def flush(self):
+        """Write pending changes now and wait for the write to finish.
+
+        A write already running in the writer thread is waited for, since 
+        writes of the task list are serialized.
+
+        """
+        with self._condition:
+            self._requested = False
+        self.task_list.write_tasks()
+
+    def close(self):
+        """Write pending changes and stop the writer thread."""
+        if self._thread is not None:
+            with self._condition:
+                self._closed = True
+                self._condition.notify()
+            self._closing.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        """Write the task list each time a write is requested."""
+        while True:
+            with self._condition:
+                while not self._requested and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+            # Let the burst of changes end before writing
+            self._closing.wait(self.delay)
+            with self._condition:
+                self._requested = False
+            try:
+                self.task_list.write_tasks()
+            except EnvironmentError as error:
+                self.error = error
+
+
+class SessionLog(object):
 
     """
+    Record timing sessions and keep time totals.
 
-    def __init__(self):
-        """Initialize task list and read tasks from .csv file."""
-        self.tasks = []
-        self.read_tasks()
+    Each session is appended to the sessions file as a line with the task 
+    uid and the start and end of the session. Totals per task, per day and 
+    per week are updated as sessions are added, and saved to a rollup file 
+    along with the length of the sessions file they cover. On startup, only
+    the sessions logged after that are read.
 
-    def add_task(self, task):
-        """Add a Task object to the task list.
+    Data attributes:
 
-        :param task: Task object to append. Currently, no check is made to 
-                     ensure this is indeed a Task instance.
+    .. attribute:: task_totals
+
+        A dictionary mapping task uids to seconds logged.
+
+    .. attribute:: day_totals
+
+        A dictionary mapping ISO dates (for example, '2011-08-29') to seconds
+        logged on that day.
+
+    .. attribute:: week_totals
+
+        A dictionary mapping ISO weeks (for example, '2011-W35') to seconds
+        logged in that week.
+
+    Public functions:
+
+    add_session -- Log a timing session.
+
+    timesheet -- Return the seconds logged on each day of a period.
+
+    week_total -- Return the seconds logged in the week of a date.
+
+    save -- Save the totals to the rollup file.
+
+    """
+
+    filename = "tasks.sessions"
+    rollup_filename = "tasks.sessions.rollup"
+
+    def __init__(self, filename=None):
+        """Read the saved totals and the sessions logged after them.
+
+        :param filename: The sessions file, if not :attr:`filename`; the 
+                         rollup file is named after it.
 
-        Append task to :attr:`tasks` and return it.
-        
         """
-        self.tasks.append(task)
-        return task
+        if filename is not None and filename != self.filename:
+            self.filename = filename
+            self.rollup_filename = filename + ".rollup"
+        self._reset()
+        self._read_rollup()
+        self._read_sessions()
 
-    def read_tasks(self):
-        """Read tasks from .csv file.
+    def add_session(self, uid, start, end):
+        """Log a timing session.
+
+        :param uid: Uid of the timed task.
+        :param start: :class:`datetime.datetime` when the session started.
+        :param end: :class:`datetime.datetime` when the session ended.
+
+        Append the session to the sessions file and update the totals with 
+        it, and with any sessions logged meanwhile by other processes.
+
+        """
+        with open(self.filename, "a") as fh:
+            fh.write("%s\t%s\t%s\n" % (uid, start.isoformat(), 
+                                       end.isoformat()))
+        self._read_sessions()
+
+    def timesheet(self, first_day, last_day):
+        """Return the seconds logged on each day of a period.
+
+        :param first_day: :class:`datetime.date` of the first day.
+        :param last_day: :class:`datetime.date` of the last day.
+
+        Return a list of (day, seconds) tuples, one for each day from 
+        first_day to last_day.
+
+        """
+        days = []
+        day = first_day
+        while day <= last_day:
+            days.append((day, self.day_totals.get(day.isoformat(), 0)))
+            day += timedelta(days=1)
+        return days
+
+    def week_total(self, day):
+        """Return the seconds logged in the ISO week of a date."""
+        return self.week_totals.get(iso_week(day), 0)
+
+    def save(self):
+        """Save the totals to the rollup file."""
+        with replaced_file(self.rollup_filename) as fh:
+            marshal.dump((self._covered, self.task_totals, self.day_totals, 
+                          self.week_totals), fh)
+
+    def _reset(self):
+        """Empty the totals."""
+        self.task_totals = {}
+        self.day_totals = {}
+        self.week_totals = {}
+        # Length of the part of the sessions file included in the totals
+        self._covered = 0
+
+    def _read_rollup(self):
+        """Read the totals saved by :meth:`save`, if any."""
+        try:
+            fh = open(self.rollup_filename, "rb")
+        except IOError:
+            return
+        with fh:
+            try:
+                (self._covered, self.task_totals, self.day_totals, 
+                 self.week_totals) = marshal.load(fh)
+            except (EOFError, ValueError, TypeError):
+                self._reset()
+
+    def _read_sessions(self):
+        """Add the sessions not yet included in the totals.
 
-        For each line in the tasks.csv file, split its contents and create a
-        :class:`Task` object. Append each object to :attr:`tasks`.
+        If the sessions file is shorter than the part already covered, it 
+        was replaced; the totals are then rebuilt from scratch. Lines that
+        cannot be parsed are skipped.
 
         """
         try:
-            fh = open("tasks.csv")
+            fh = open(self.filename)
         except IOError:
-            pass
-        else:
-            for line in fh:
-                line = line.strip()
-                args = line.split('\t')
-                task = Task(*args) 
-                self.tasks.append(task)
+            return
+        with fh:
+            if os.fstat(fh.fileno()).st_size < self._covered:
+                self._reset()
+            fh.seek(self._covered)
+            for line in iter(fh.readline, ''):
+                if not line.endswith('\n'):
+                    # Interrupted write
+                    break
+                self._covered += len(line)
+                try:
+                    uid, start, end = line[:-1].split('\t')
+                    start, end = parse_date(start), parse_date(end)
+                except ValueError:
+                    # Not written by taskmage
+                    continue
+                self._add(uid, start, end)
 
-    def filter_tasks(self, **kwargs):
-        """Return a list of tasks that match certain criteria.
+    def _add(self, uid, start, end):
+        """Add a session to the totals, splitting it at midnight."""
+        while start < end:
+            midnight = datetime.combine(start.date() + timedelta(days=1), 
+                                        datetime.min.time())
+            part_end = min(end, midnight)
+            seconds = total_seconds(part_end - start)
+            day = start.date()
+            self.task_totals[uid] = self.task_totals.get(uid, 0) + seconds
+            key = day.isoformat()
+            self.day_totals[key] = self.day_totals.get(key, 0) + seconds
+            key = iso_week(day)
+            self.week_totals[key] = self.week_totals.get(key, 0) + seconds
+            start = part_end
 
-        :param \*\*kwargs: A dictionary whose keys are :class:`Task` object
-                         attributes and whose values are lists of desired 
-                         values for each attribute. For example:
 
-        {status: ['needs-action', 'in-process']}
+class TimerSet(object):
 
-        Iterate attributes in \*\*kwargs; for each attribute, iterate
-        tasks and append current task to a set if the task attribute is  
-        included in the filter values for that attribute. Return a list of 
-        tasks that match all criteria.
+    """
+    Run timers on several tasks at once and checkpoint them to a file.
+
+    The open timers of each process are kept in the timers file, one line
+    per timer with the process id, the task uid, the start of the timer and
+    the time of the last checkpoint. The lines are rewritten when a timer
+    starts or stops and by :meth:`checkpoint`, which callers run when
+    :meth:`checkpoint_due` says so, or before exiting. Lines left by a 
+    process that is no longer running are handed over by :meth:`recover`, 
+    so that a crash loses at most :attr:`checkpoint_interval` seconds.
+
+    Data attributes:
+
+    .. attribute:: timers
+
+        An ordered dictionary mapping the uids of timed tasks to the
+        :class:`datetime.datetime` when their timer started.
+
+    .. attribute:: checkpoint_interval
+
+        Seconds between checkpoints.
+
+    Public functions:
+
+    start -- Start a timer.
+
+    stop -- Stop a timer and return when it started.
+
+    elapsed -- Return the seconds a timer has been running.
+
+    next_wakeup -- Return the seconds until the timers need attention.
+
+    checkpoint_due -- Return True if the timers should be checkpointed.
+
+    checkpoint -- Write the open timers to the timers file.
+
+    recover -- Take over the timers of processes no longer running.
+
+    """
+
+    filename = "tasks.timers"
+    lock_filename = "tasks.timers.lock"
+
+    def __init__(self, checkpoint_interval=60, filename=None):
+        """Start with no timers; the timers file is not read.
+
+        :param checkpoint_interval: Seconds between checkpoints.
+        :param filename: The timers file, if not :attr:`filename`; the lock
+                         file is named after it.
 
         """
-        tasks = self.tasks
-        filtered_tasks = set()
-        for attr, values in kwargs.iteritems():
-            for task in tasks:
-                try:
-                    task_attr = getattr(task, attr)
-                except AttributeError:
-                    break
-                if task_attr in values:
-                    filtered_tasks.add(task)
-            tasks = list(filtered_tasks)
-        return tasks
-        
-    def write_tasks(self):
-        """Write tasks to .csv file.
-        
-        Iterate :attr:`tasks` and write each line to the tasks.csv file.
+        if filename is not None and filename != self.filename:
+            self.filename = filename
+            self.lock_filename = filename + ".lock"
+        self.timers = OrderedDict()
+        self.checkpoint_interval = checkpoint_interval
+        self._checkpointed = None
+        self._pid = os.getpid()
+
+    def start(self, uid, now=None):
+        """Start a timer on the task with the given uid."""
+        now = now or datetime.now()
+        self.timers[uid] = now
+        self.checkpoint(now)
+
+    def stop(self, uid, now=None):
+        """Stop the timer of a task and return when it started."""
+        start = self.timers.pop(uid)
+        self.checkpoint(now)
+        return start
+
+    def elapsed(self, uid, now=None):
+        """Return the whole seconds the timer of a task has been running."""
+        return total_seconds((now or datetime.now()) - self.timers[uid])
+
+    def next_wakeup(self, shown=(), now=None):
+        """Return the seconds until the timers need attention, or None.
+
+        :param shown: Uids of the timers whose elapsed time is displayed.
+
+        That is the time until the elapsed time of a shown timer reaches the
+        next whole second, or until the next checkpoint is due. Return None 
+        if no timer is running.
 
         """
-        with open ("tasks.csv", "w") as fh:
-            for task in self.tasks:
-                fh.write('\t'.join([task.uid, 
-                                    task.summary, 
-                                    task.description,
-                                    task.date,
-                                    task.status,
-                                    str(task.logged_time)]))
-                fh.write('\n')
+        if not self.timers:
+            return None
+        now = now or datetime.now()
+        wakeup = self.checkpoint_interval
+        if self._checkpointed is not None:
+            wakeup -= seconds_between(self._checkpointed, now)
+        for uid in shown:
+            start = self.timers.get(uid)
+            if start is not None:
+                wakeup = min(wakeup, 1 - (now - start).microseconds / 1e6)
+        return max(wakeup, 0)
+
+    def checkpoint_due(self, now=None):
+        """Return True if the open timers should be checkpointed."""
+        if not self.timers or self._checkpointed is None:
+            return False
+        elapsed = seconds_between(self._checkpointed, now or datetime.now())
+        return elapsed >= self.checkpoint_interval
+
+    def checkpoint(self, now=None):
+        """Write the open timers to the timers file.
+
+        The lines of other processes are kept. The file is replaced through 
+        a temporary file and forced to disk, and removed once no timer is 
+        left in it.
+
+        """
+        now = now or datetime.now()
+        with file_lock(self.lock_filename):
+            lines = [line for line in self._read() 
+                     if line[0] != self._pid]
+            self._write(lines, now)
+        self._checkpointed = now
+
+    def recover(self):
+        """Take over the timers of processes no longer running.
+
+        Remove their lines from the timers file and return a list of 
+        (uid, start, checkpoint) tuples, where start and checkpoint are 
+        :class:`datetime.datetime` objects. Time after the checkpoint was 
+        not recorded.
+
+        """
+        with file_lock(self.lock_filename):
+            lines = self._read()
+            recovered = [line for line in lines 
+                         if not process_running(line[0])]
+            if recovered:
+                self._write([line for line in lines 
+                             if line not in recovered and 
+                             line[0] != self._pid], datetime.now())
+        return [(uid, start, checkpoint) 
+                for pid, uid, start, checkpoint in recovered]
+
+    def _read(self):
+        """Return the lines of the timers file as tuples."""
+        try:
+            fh = open(self.filename)
+        except IOError:
+            return []
+        lines = []
+        with fh:
+            for line in fh:
+                try:
+                    pid, uid, start, checkpoint = line.rstrip('\n').split('\t')
+                    lines.append((int(pid), uid, parse_date(start), 
+                                  parse_date(checkpoint)))
+                except ValueError:
+                    # Interrupted write
+                    continue
+        return lines
+
+    def _write(self, lines, now):
+        """Replace the timers file with lines and this process's timers."""
+        lines = lines + [(self._pid, uid, start, now) 
+                         for uid, start in self.timers.iteritems()]
+        if not lines:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+            return
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as fh:
+            for pid, uid, start, checkpoint in lines:
+                fh.write("%d\t%s\t%s\t%s\n" % (pid, uid, start.isoformat(), 
+                                                checkpoint.isoformat()))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_filename, self.filename)
+
+
+def task_fields(task):
+    """Return a list with the string values of task's :data:`FIELDS`."""
+    return [task.uid, 
+            task.summary, 
+            task.description,
+            task.date,
+            task.status,
+            str(task.logged_time)]
+
+def task_values(task):
+    """Return a tuple with the values of task's :data:`FIELDS`."""
+    return (task.uid, 
+            task.summary, 
+            task.description,
+            task.date,
+            task.status,
+            task.logged_time)
+
+def apply_changes(fields, changes):
+    """Apply journal changes to the split fields of a task line.
+
+    :param fields: List of field values, in :data:`FIELDS` order.
+    :param changes: Dictionary mapping field positions to new values.
+
+    """
+    for column, value in changes.iteritems():
+        if column < len(fields):
+            fields[column] = value
+    if _DATE in changes:
+        # Drop the parsed creation date that follows cached fields
+        del fields[len(FIELDS):]
+
+def file_stat(filename):
+    """Return the inode, modification time and size of a file, or None."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+@contextmanager
+def replaced_file(filename):
+    """Write a new version of a file through a unique temporary file.
+
+    Yield a binary file open for writing, in the directory of filename. If
+    the block completes, the temporary file replaces filename; otherwise it
+    is removed. Processes writing the same file at once never share a 
+    temporary file, and the last one to finish wins.
+
+    """
+    import tempfile
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or '.', 
+        prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            yield fh
+        os.rename(tmp_filename, filename)
+    except:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+@contextmanager
+def file_lock(filename, shared=False):
+    """Hold a shared or exclusive lock on a lock file.
+
+    Where files cannot be locked, because :mod:`fcntl` is missing or the 
+    lock file cannot be created, nothing is locked.
+
+    """
+    try:
+        fh = open(filename, "a") if fcntl else None
+    except IOError:
+        # Read-only directory
+        fh = None
+    if fh is None:
+        yield
+        return
+    with fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+def process_running(pid):
+    """Return True if a process with the given id is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        # The process exists but belongs to another user
+        return error.errno == errno.EPERM
+    return True
+
+def task_list_memory(task_list, sample=100):
+    """Estimate the bytes of memory taken by the tasks of a task list.
+
+    The task objects and their strings are measured on up to sample tasks 
+    spread over the list, and each task is counted with its share of the 
+    indexes of the list.
+
+    """
+    tasks = task_list.tasks
+    if not tasks:
+        return 0
+    sampled = tasks[::max(1, len(tasks) // sample)]
+    size = 0
+    for task in sampled:
+        size += sys.getsizeof(task)
+        for attr in ('uid', 'summary', 'description', 'date'):
+            size += sys.getsizeof(getattr(task, attr))
+    # Entries in the uid and status indexes, and in the list of tasks
+    index_bytes = 150
+    return (size // len(sampled) + index_bytes) * len(tasks)
+
+def cpu_count():
+    """Return the number of CPUs, or 0 if files cannot be parsed in a pool."""
+    try:
+        import multiprocessing
+        # Fails on platforms that lack a working sem_open
+        import multiprocessing.synchronize
+    except ImportError:
+        return 0
+    return multiprocessing.cpu_count()
+
+def line_ranges(fh, size, count):
+    """Divide a file into about count byte ranges of whole lines.
+
+    :param fh: The open file.
+    :param size: Size of the file.
+    :param count: Number of ranges wanted.
+
+    Return a list of (start, end) tuples; each range but the last ends 
+    right after a line break.
+
+    """
+    ranges = []
+    start = 0
+    for i in xrange(1, count):
+        fh.seek(max(size * i // count, start))
+        fh.readline()
+        end = fh.tell()
+        if end >= size:
+            break
+        if end > start:
+            ranges.append((start, end))
+            start = end
+    ranges.append((start, size))
+    return ranges
+
+def parse_range(job):
+    """Split the task lines in a byte range of a file.
+
+    :param job: Tuple with the file name and the start and end of the range.
+
+    Run in the worker processes of :meth:`TaskListCSV._iter_parallel`. 
+    Return a :mod:`marshal` string of a tuple with the list of field tuples
+    of the non-empty lines and the list of their encoded creation dates, 
+    which is much faster to pass back than pickled lists.
+
+    """
+    filename, start, end = job
+    with open(filename, "rb") as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    rows = []
+    dates = []
+    for line in data.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        fields = tuple(line.split('\t'))
+        rows.append(fields)
+        dates.append(encode_date(fields[_DATE]) if len(fields) > _DATE 
+                     else None)
+    return marshal.dumps((rows, dates))
+
+def encode_date(date):
+    """Return the pickle state of a creation date, or None if invalid.
+
+    :class:`datetime.datetime` decodes the short string much faster than 
+    an ISO string.
+
+    """
+    created = created_or_none(date)
+    return created.__reduce__()[1][0] if created else None
+
+def read_segment(filename):
+    """Return the field lists of the task lines in a gzip archive segment.
+
+    Segments are small enough, holding the tasks of a month, to be 
+    decompressed at once, which is much faster than reading them by line.
+
+    """
+    import gzip
+    with gzip.open(filename, "rb") as fh:
+        data = fh.read()
+    return [line.split('\t') for line in data.split('\n') if line.strip()]
+
+def file_digest(filename):
+    """Return the hex SHA-1 digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+@contextmanager
+def paused_gc():
+    """Disable the cyclic garbage collector while creating many tasks.
+
+    Task objects hold no reference cycles, but each allocation counts towards
+    the collector thresholds, so loading a large list would otherwise trigger 
+    repeated full collections.
+
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
         
 
 class Task(object):
     """Define task properties.
 
+    Tasks use __slots__ instead of an instance dictionary, and statuses are
+    interned, so that large task lists take little memory.
+
     Data attributes:
 
     .. attribute:: uid
@@ -134,7 +3419,13 @@ class Task(object):
 
     .. attribute:: date
 
-        Creation date of the task.
+        Creation date of the task, as an ISO 8601 string.
+
+    .. attribute:: created
+
+        Creation date of the task, as a :class:`datetime.datetime` object.
+        Parsed from :attr:`date` on first access, unless it was given when 
+        the task was created.
 
     .. attribute:: status
 
@@ -145,18 +3436,28 @@ class Task(object):
 
         Time, in seconds, that has been spent on the task.
 
+    .. attribute:: version
+
+        Number of changes made to the task by task lists since it was 
+        created, so that what is derived from its fields can be kept until
+        they change.
+
     """
+    __slots__ = ('uid', 'summary', 'description', '_date', '_created', 
+                 '_status', 'logged_time', 'version')
+
     def __init__(self, 
                  uid=None, 
                  summary=None, 
                  description=None, 
                  date=None,
                  status='needs-action',
-                 logged_time=0):
+                 logged_time=0,
+                 created=None):
         if not uid:
             # If not uid is given, this is a new task. Assign it an uid.
             self.date = datetime.now().isoformat()
-            self.uid = '@'.join([self.date, socket.getfqdn()])
+            self.uid = uid_generator.new_uid(self.date)
         else:
             self.uid = uid
             self.date = date
@@ -164,6 +3465,285 @@ class Task(object):
         self.description = description
         self.status = status
         self.logged_time = int(logged_time)
+        self.version = 0
+        if created is not None:
+            self._created = created
 
     def __repr__(self):
         return self.summary
+
+    def _get_date(self):
+        return self._date
+
+    def _set_date(self, date):
+        self._date = date
+        self._created = None
+
+    date = property(_get_date, _set_date)
+
+    @property
+    def created(self):
+        if self._created is None and self._date:
+            self._created = parse_date(self._date)
+        return self._created
+
+    def _get_status(self):
+        return self._status
+
+    def _set_status(self, status):
+        # Share one string object per status among all tasks
+        self._status = intern(status) if type(status) is str else status
+
+    status = property(_get_status, _set_status)
+
+
+def parse_date(date):
+    """Parse a date written by :meth:`datetime.datetime.isoformat`.
+
+    :param date: ISO 8601 string, with or without microseconds.
+
+    Slicing the fixed positions of the string is much faster than 
+    :func:`datetime.datetime.strptime`, which matters when a whole task list
+    is decoded.
+
+    """
+    microsecond = int(date[20:26].ljust(6, '0')) if len(date) > 20 else 0
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                    int(date[11:13]), int(date[14:16]), int(date[17:19]),
+                    microsecond)
+
+def total_seconds(delta):
+    """Return the whole number of seconds in a timedelta."""
+    return delta.days * 86400 + delta.seconds
+
+def seconds_between(start, end):
+    """Return the seconds from start to end, with fractions."""
+    delta = end - start
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def iso_week(day):
+    """Return the ISO week of a date, for example '2011-W35'."""
+    year, week, weekday = day.isocalendar()
+    return "%04d-W%02d" % (year, week)
+
+def created_or_none(date):
+    """Return date parsed by :func:`parse_date`, or None if it is invalid."""
+    try:
+        return parse_date(date)
+    except (TypeError, ValueError):
+        return None
+
+
+class UidGenerator(object):
+
+    """
+    Generate unique task identifiers.
+
+    Uids have the form date-pid.sequence@host. The sequence number makes 
+    uids created in the same microsecond by the same process unique. 
+
+    The fully qualified host name is resolved once, in a background thread
+    started with the first uid, since the lookup can block for seconds on 
+    hosts with slow or missing DNS. Until it is resolved, the plain host 
+    name is used. Nothing is looked up until a uid is needed, so that 
+    programs that only read tasks do not pay for it.
+
+    Data attributes:
+
+    .. attribute:: host
+
+        Host part of the uids, or None until the first uid is made.
+
+    Public functions:
+
+    new_uid -- Return a new uid.
+
+    """
+
+    def __init__(self):
+        self.host = None
+        self._sequence = count()
+        self._lock = threading.Lock()
+
+    def _start_host(self):
+        """Use the host name and start resolving the qualified one."""
+        import socket
+        with self._lock:
+            if self.host is not None:
+                return
+            self.host = socket.gethostname()
+        resolver = threading.Thread(target=self._resolve_host)
+        resolver.daemon = True
+        resolver.start()
+
+    def _resolve_host(self):
+        """Replace :attr:`host` with the fully qualified host name."""
+        import socket
+        self.host = socket.getfqdn()
+
+    def new_uid(self, date):
+        """Return a new uid.
+
+        :param date: Creation date of the task, as an ISO 8601 string.
+
+        """
+        if self.host is None:
+            self._start_host()
+        return "%s-%d.%d@%s" % (date, os.getpid(), next(self._sequence), 
+                                self.host)
+
+
+# Shared by all new tasks
+uid_generator = UidGenerator()
+
+
+def read_new_tasks(lines, input_format, errors):
+    """Yield a new :class:`Task` for each line of input.
+
+    :param lines: Iterable of lines.
+    :param input_format: 'tsv' for lines with a summary and, optionally, a 
+                         description, status and logged time separated by 
+                         tabs; 'json' for JSON objects with those keys.
+    :param errors: List to which a message is appended for each line that 
+                   cannot be read; those lines are skipped.
+
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        try:
+            if input_format == 'json':
+                import json
+                values = json.loads(line)
+                values = [values.get(key) for key in 
+                          ('summary', 'description', 'status', 'logged_time')]
+            else:
+                values = line.split('\t')
+            values = [clean_field(value) if value is not None else '' 
+                      for value in values]
+            values.extend([''] * (4 - len(values)))
+            summary, description, status, logged_time = values[:4]
+            if not summary:
+                raise ValueError("no summary")
+            if status and status not in STATUSES:
+                raise ValueError("unknown status %r" % status)
+            task = Task(summary=summary, description=description, 
+                        status=status or 'needs-action', 
+                        logged_time=logged_time or 0)
+        except (AttributeError, TypeError, ValueError) as error:
+            errors.append("line %d: %s" % (number, error))
+            continue
+        yield task
+
+def clean_field(value):
+    """Return value as a UTF-8 string without tabs or line breaks."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return ' '.join(str(value).replace('\t', ' ').splitlines())
+
+def format_task(task, output_format):
+    """Return task as a TSV line or as a line with a JSON object."""
+    if output_format == 'json':
+        import json
+        return json.dumps(dict(zip(FIELDS, task_values(task))), 
+                          sort_keys=True) + '\n'
+    return '\t'.join(task_fields(task)) + '\n'
+
+def main(argv=None):
+    """Add, list or complete tasks without an interactive interface.
+
+    :param argv: List of command line arguments; sys.argv by default.
+
+    Subcommands:
+
+    add -- Read new tasks from standard input and append them to the .csv
+           file.
+
+    query -- Write the tasks that match the given statuses and uids to 
+             standard output.
+
+    done -- Mark the tasks with the given uids, or those read from standard
+            input, completed.
+
+    archive -- Move finished tasks from the .csv file to the archive.
+
+    Except for archive, which reads the .csv file, input and output are 
+    streamed, so memory use does not depend on the number of tasks. Return
+    the exit status.
+
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage tasks in batch.")
+    parser.add_argument('--fsync', choices=TaskListCSV.fsync_policies,
+                        default='rewrite',
+                        help="when writes are forced to disk "
+                             "(default: rewrite)")
+    parser.add_argument('--list', default='tasks',
+                        help="name of the task list, which is kept in "
+                             "NAME.csv (default: tasks)")
+    subparsers = parser.add_subparsers(dest='command')
+    add_parser = subparsers.add_parser(
+        'add', help="add tasks read from standard input, one per line")
+    add_parser.add_argument('--format', choices=['tsv', 'json'], 
+                            default='tsv',
+                            help="tab separated summary, description, status "
+                                 "and logged time, or JSON objects with "
+                                 "those keys (default: tsv)")
+    query_parser = subparsers.add_parser(
+        'query', help="write matching tasks to standard output")
+    query_parser.add_argument('--status', action='append',
+                              help="show tasks with this status; may be "
+                                   "repeated")
+    query_parser.add_argument('--uid', action='append',
+                              help="show the task with this uid; may be "
+                                   "repeated")
+    query_parser.add_argument('--format', choices=['tsv', 'json'], 
+                              default='tsv')
+    done_parser = subparsers.add_parser(
+        'done', help="mark tasks completed by uid")
+    done_parser.add_argument('uids', nargs='*', 
+                             help="uids of the tasks; read from standard "
+                                  "input, one per line, if none are given")
+    subparsers.add_parser(
+        'archive', help="move finished tasks to the compressed archive")
+    args = parser.parse_args(argv)
+    if args.command == 'archive':
+        TaskListCSV(fsync=args.fsync, lazy=True, archive=True, 
+                    filename=args.list + ".csv").compact()
+        return 0
+    task_list = TaskListCSV(fsync=args.fsync, read=False, 
+                            filename=args.list + ".csv")
+    if args.command == 'add':
+        errors = []
+        added = task_list.append_tasks(
+            read_new_tasks(sys.stdin, args.format, errors))
+        for error in errors:
+            sys.stderr.write("Skipped %s\n" % error)
+        sys.stderr.write("Added %d tasks\n" % added)
+        return 1 if errors else 0
+    if args.command == 'query':
+        criteria = {}
+        if args.status:
+            criteria['status'] = args.status
+        if args.uid:
+            criteria['uid'] = args.uid
+        try:
+            for task in task_list.iter_tasks(**criteria):
+                sys.stdout.write(format_task(task, args.format))
+            sys.stdout.flush()
+        except IOError as error:
+            # The reader, for example head, has gone away
+            if error.errno != errno.EPIPE:
+                raise
+        return 0
+    uids = args.uids or (line.strip() for line in sys.stdin)
+    done = task_list.append_statuses((uid for uid in uids if uid), 
+                                     'completed')
+    # Uids without a task are not looked up, only ignored when read back
+    sys.stderr.write("Wrote %d completed status records\n" % done)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
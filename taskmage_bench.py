@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the task list and the curses interface hot paths.
+
+Generate synthetic task lists, time the task list operations and the
+curses drawing functions against an in-memory screen, and print one JSON
+object per result, so that runs on different commits can be compared.
+Nothing is drawn on the terminal.
+
+Exported Classes:
+
+FakeCurses -- Stands in for the curses module.
+
+FakeWindow -- Stands in for curses windows and pads.
+
+Example:
+
+    python taskmage_bench.py --rows 1000 100000 --output before.jsonl
+    python taskmage_bench.py --rows 1000 100000 --compare before.jsonl
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+import taskmage_curses
+from taskmage import TaskListCSV, TimerSet, WriteBehind
+
+class FakeWindow(object):
+
+    """
+    Stand in for a curses window or pad.
+
+    Keep the text written to each row, so that drawing costs about as much
+    string handling as it does on a real screen.
+
+    """
+
+    def __init__(self, screen, height, width, begin_y=0, begin_x=0):
+        self.screen = screen
+        self.height = height
+        self.width = width
+        self.begin_y = begin_y
+        self.begin_x = begin_x
+        self.rows = {}
+        self.y = self.x = 0
+
+    def addstr(self, *args):
+        if len(args) > 2 or (len(args) == 2 and isinstance(args[0], int)):
+            self.y, self.x = args[0], args[1]
+            text = args[2]
+        else:
+            text = args[0]
+        if not 0 <= self.y < self.height:
+            raise self.screen.error("addstr() returned ERR")
+        self.rows[self.y] = text
+        self.x += len(text)
+
+    def clear(self):
+        self.rows = {}
+
+    erase = clear
+
+    def getbegyx(self):
+        return self.begin_y, self.begin_x
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def hline(self, y, x, char, length):
+        self.rows[y] = char * length
+
+    def move(self, y, x):
+        self.y, self.x = y, x
+
+    def refresh(self, *args):
+        """Move the screen cursor to the window cursor.
+
+        For pads, the arguments are the first pad row and column shown and
+        the screen row and column where they are shown, as in curses.
+
+        """
+        if args:
+            pminrow, pmincol, sminrow, smincol = args[:4]
+            self.screen.cursor = (sminrow + self.y - pminrow,
+                                  smincol + self.x - pmincol)
+        else:
+            self.screen.cursor = (self.begin_y + self.y,
+                                  self.begin_x + self.x)
+
+    def resize(self, height, width):
+        self.height, self.width = height, width
+
+
+class FakeCurses(object):
+
+    """
+    Stand in for the curses module.
+
+    Provide the attributes and functions used by :mod:`taskmage_curses` while
+    drawing, and track the screen cursor for :meth:`getsyx`.
+
+    """
+
+    A_NORMAL = 0
+    A_BOLD = 1 << 21
+    A_REVERSE = 1 << 18
+
+    class error(Exception):
+        pass
+
+    def __init__(self):
+        self.cursor = (0, 0)
+
+    def getsyx(self):
+        return self.cursor
+
+    def newpad(self, height, width):
+        return FakeWindow(self, height, width)
+
+    def newwin(self, height, width, begin_y=0, begin_x=0):
+        return FakeWindow(self, height, width, begin_y, begin_x)
+
+    def curs_set(self, visibility):
+        pass
+
+
+def generate_tasks_file(filename, rows, status_mix, description_length,
+                        seed=0):
+    """Write a synthetic task list.
+
+    :param filename: Path of the .csv file to write.
+    :param rows: Number of tasks.
+    :param status_mix: Dictionary mapping statuses to their relative weight.
+    :param description_length: Number of characters in each description.
+    :param seed: Seed for the random number generator.
+
+    """
+    rng = random.Random(seed)
+    statuses = []
+    for status, weight in sorted(status_mix.iteritems()):
+        statuses.extend([status] * int(weight * 100))
+    start = datetime(2011, 8, 29, 17, 37, 19)
+    words = ['task', 'review', 'write', 'call', 'fix', 'plan', 'read', 'send']
+    with open(filename, "w") as fh:
+        for i in xrange(rows):
+            date = (start + timedelta(seconds=i * 61)).isoformat()
+            summary = "%s %s %d" % (rng.choice(words), rng.choice(words), i)
+            description = ''.join(rng.choice('abcdefgh ')
+                                  for _ in xrange(description_length))
+            fh.write('\t'.join([
+                "%s@bench" % date,
+                summary,
+                description.strip() or 'x',
+                date,
+                rng.choice(statuses),
+                str(rng.randint(0, 36000))]))
+            fh.write('\n')
+
+def remove_sidecars():
+    """Remove the journal and cache files of the task list."""
+    for filename in [TaskListCSV.journal_filename, TaskListCSV.cache_filename]:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def setup_screen(task_list, height=50, width=100):
+    """Point the curses interface at a fake screen and task list.
+
+    :param task_list: Task list shown by the interface.
+
+    Set the module globals that :mod:`taskmage_curses` creates at startup.
+
+    """
+    fake_curses = FakeCurses()
+    ui = taskmage_curses
+    ui.curses = fake_curses
+    ui.task_list = task_list
+    ui.writer = WriteBehind(task_list, delay=None)
+    ui.timers = TimerSet()
+    ui.stdscr = fake_curses.newwin(height, width)
+    ui.screen_height, ui.screen_width = height, width
+    ui.status_bar = fake_curses.newwin(1, width, height - 1, 0)
+    ui.task_endrow = 15
+    ui.task_pad = fake_curses.newpad(ui.task_endrow + 1, width - 1)
+    ui.view = {}
+    ui.details_win = fake_curses.newwin(height - ui.task_endrow - 4, width,
+                                        ui.task_endrow + 2, 0)
+    ui.items = ui.ItemList(
+        task_list.filter_tasks(status=['needs-action', 'in-process']))
+
+def best_time(function, repeat):
+    """Return the best of repeat timings of function, in seconds."""
+    timings = []
+    for _ in xrange(repeat):
+        start = timeit.default_timer()
+        function()
+        timings.append(timeit.default_timer() - start)
+    return min(timings)
+
+def run_benchmarks(rows, repeat, status_mix, description_length, moves):
+    """Run all benchmarks on a synthetic list; yield result dictionaries.
+
+    :param rows: Number of tasks in the list.
+    :param repeat: Number of timings of each benchmark; the best is kept.
+    :param status_mix: Dictionary mapping statuses to their relative weight.
+    :param description_length: Number of characters in each description.
+    :param moves: Number of cursor moves timed by the move benchmark.
+
+    """
+    ui = taskmage_curses
+    generate_tasks_file(TaskListCSV.filename, rows, status_mix,
+                        description_length)
+
+    def read_cold():
+        remove_sidecars()
+        TaskListCSV()
+
+    def move_down():
+        offset = 0
+        for _ in xrange(moves):
+            offset = ui.move(ui.task_pad, ui.draw_tasks, ui.task_endrow,
+                             offset, 'add')
+
+    def write_journal():
+        journal_list.update_task(journal_list.tasks[0], logged_time=rows)
+        journal_list.write_tasks()
+
+    def draw_full():
+        ui.reset_view()
+        ui.draw_tasks()
+
+    results = [('read_tasks_cold', read_cold)]
+    results.append(('read_tasks', TaskListCSV))
+    results.append(('read_tasks_lazy', lambda: TaskListCSV(lazy=True)))
+    task_list = TaskListCSV()
+    open_statuses = ['needs-action', 'in-process']
+    results.append(('filter_tasks',
+                    lambda: task_list.filter_tasks(status=open_statuses)))
+    results.append(('write_tasks', task_list.write_tasks))
+    journal_list = TaskListCSV(journal=True)
+    results.append(('write_tasks_journal', write_journal))
+    open_tasks = task_list.filter_tasks(status=open_statuses)
+    results.append(('sort_items', lambda: ui.ItemList(open_tasks)))
+    setup_screen(task_list)
+    results.append(('draw_tasks', draw_full))
+    results.append(('move', move_down))
+    for name, function in results:
+        yield {'benchmark': name,
+               'rows': rows,
+               'seconds': best_time(function, repeat)}
+
+def git_commit():
+    """Return the current git commit of the source tree, or None."""
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.strip()
+
+def compare(results, filename):
+    """Print the ratio between results and those in a previous run.
+
+    :param results: List of result dictionaries.
+    :param filename: JSON lines file written by a previous run.
+
+    """
+    previous = {}
+    with open(filename) as fh:
+        for line in fh:
+            result = json.loads(line)
+            previous[result['benchmark'], result['rows']] = result['seconds']
+    for result in results:
+        key = result['benchmark'], result['rows']
+        if key in previous and previous[key]:
+            sys.stderr.write("%-20s %8d rows %6.2fx\n" % (
+                key + (result['seconds'] / previous[key],)))
+
+def parse_status_mix(string):
+    """Parse a status mix like 'needs-action=0.2,completed=0.8'."""
+    mix = {}
+    for item in string.split(','):
+        status, weight = item.split('=')
+        mix[status] = float(weight)
+    return mix
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time task list and curses interface hot paths.")
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help="list sizes to generate (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timings per benchmark; the best is reported")
+    parser.add_argument('--status-mix', type=parse_status_mix,
+                        default='needs-action=0.15,in-process=0.05,'
+                                'completed=0.75,cancelled=0.05',
+                        help="relative weight of each status")
+    parser.add_argument('--description-length', type=int, default=60)
+    parser.add_argument('--moves', type=int, default=100,
+                        help="cursor moves timed by the move benchmark")
+    parser.add_argument('--output', help="append results to this file")
+    parser.add_argument('--compare',
+                        help="print speed ratios against a previous output")
+    args = parser.parse_args(argv)
+    commit = git_commit()
+    results = []
+    directory = tempfile.mkdtemp(prefix='taskmage_bench')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        for rows in args.rows:
+            for result in run_benchmarks(rows, args.repeat, args.status_mix,
+                                         args.description_length, args.moves):
+                result['commit'] = commit
+                results.append(result)
+                line = json.dumps(result, sort_keys=True)
+                print(line)
+                sys.stdout.flush()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    if args.output:
+        with open(args.output, "a") as fh:
+            for result in results:
+                fh.write(json.dumps(result, sort_keys=True) + '\n')
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
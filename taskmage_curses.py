@@ -1,19 +1,174 @@
 #!/usr/bin/env python
 
+import time
+# Names and end times of the startup phases shown by --startup-report
+startup_times = [('start', time.time())]
+
+import argparse
+import bisect
 import curses
+import heapq
 import locale
+import marshal
 import operator
-from dateutil import parser as date_parser
-from datetime import datetime
+import os
+import signal
+import sys
+import threading
+from datetime import date, datetime, timedelta
+# dateutil is imported when a time is first edited, as it is slow to import
+
+startup_times.append(('standard modules imported', time.time()))
+
+import taskmage
+from taskmage import (And, Equal, Range, SessionLog, Task, TaskListCSV, 
+                      TaskListRegistry, TaskListSQLite, TimerSet, WriteBehind,
+                      instrumented, migrate_csv_to_sqlite, replaced_file, 
+                      seconds_between, task_fields, total_seconds)
+
+startup_times.append(('taskmage imported', time.time()))
+
+OPEN_TASKS = Equal('status', *TaskListCSV.active_statuses)
+# Task list views switched by the 'v' key: their names and functions that
+# return their query, so that dates are relative to when a view is shown
+VIEWS = [
+    ('open', lambda: OPEN_TASKS),
+    ('in process', lambda: Equal('status', 'in-process')),
+    ('created this week', 
+     lambda: And(OPEN_TASKS, Range('date', low=week_start().isoformat()))),
+    ('over an hour logged', 
+     lambda: And(OPEN_TASKS, Range('logged_time', low=3601))),
+    ('finished', lambda: Equal('status', 'completed', 'cancelled')),
+]
+# Strings drawn for each task of the current list, by uid; see rendered()
+# and list_state()
+render_cache = {}
+# Positions in the tuples of render_cache
+_TASK, _VERSION, _WIDTH, _LINE, _ENCODED_LINE, _DETAILS = range(6)
+
+class ItemList(object):
+
+    """
+    Keep the displayed tasks sorted.
+
+    Tasks are kept in a list ordered by one of the :attr:`sort_keys`, with a 
+    parallel list of their keys. Keys end with the task uid, so the order is
+    total and stable across runs. Inserting, finding and removing a task use
+    bisection on the keys instead of sorting the whole list again.
+
+    Data attributes:
+
+    .. attribute:: sort_order
+
+        Name of the current sort key.
+
+    Public functions:
+
+    insert -- Insert a task in order and return its index.
+
+    pop -- Remove the task at an index and return it.
+
+    index -- Return the index of a task.
+
+    update -- Move a task whose attributes changed to its new position.
+
+    replace -- Replace the tasks, keeping the sort order.
+
+    sort_by -- Sort the tasks by another key.
+
+    """
+
+    sort_keys = {
+        'date': lambda task: (task.date, task.uid),
+        'status': lambda task: (task.status, task.date, task.uid),
+        'logged_time': lambda task: (task.logged_time, task.date, task.uid),
+        'summary': lambda task: (task.summary, task.date, task.uid),
+    }
+    sort_orders = ('date', 'status', 'logged_time', 'summary')
+
+    def __init__(self, tasks=(), sort_order='date'):
+        self.tasks = list(tasks)
+        self.sort_by(sort_order)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __getitem__(self, index):
+        return self.tasks[index]
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __contains__(self, task):
+        return task in self._task_keys
 
-from taskmage import Task, TaskListCSV
+    @instrumented('items.replace')
+    def replace(self, tasks):
+        """Replace the tasks, keeping the sort order."""
+        self.tasks = list(tasks)
+        self.sort_by(self.sort_order)
 
-def add_task():
+    @instrumented('items.insert')
+    def insert(self, task):
+        """Insert a task in order and return its index."""
+        key = self._key(task)
+        index = bisect.bisect_right(self.keys, key)
+        self.keys.insert(index, key)
+        self.tasks.insert(index, task)
+        self._task_keys[task] = key
+        return index
+
+    @instrumented('items.pop')
+    def pop(self, index):
+        """Remove the task at an index and return it."""
+        del self.keys[index]
+        task = self.tasks.pop(index)
+        del self._task_keys[task]
+        return task
+
+    def index(self, task):
+        """Return the index of a task.
+
+        Use the key the task was inserted with, so the task is found even if
+        its attributes changed since.
+
+        """
+        index = bisect.bisect_left(self.keys, self._task_keys[task])
+        if self.tasks[index] is not task:
+            raise ValueError("%r is not in the list" % task)
+        return index
+
+    @instrumented('items.update')
+    def update(self, task):
+        """Move a task whose attributes changed; return its new index."""
+        if self._key(task) == self._task_keys[task]:
+            return self.index(task)
+        self.pop(self.index(task))
+        return self.insert(task)
+
+    @instrumented('items.sort_by')
+    def sort_by(self, sort_order):
+        """Sort the tasks by another key.
+
+        :param sort_order: One of :attr:`sort_orders`.
+
+        """
+        self.sort_order = sort_order
+        self._key = self.sort_keys[sort_order]
+        decorated = sorted((self._key(task), task) for task in self.tasks)
+        self.keys = [key for key, task in decorated]
+        self.tasks = [task for key, task in decorated]
+        self._task_keys = dict((task, key) for key, task in decorated)
+
+
+def add_task(offset):
     """Add a task.
 
-    Create new :class:`Task` object, append it to the task list and adjust the
-    items dictionary and the task pad height accordingly. Draw the updated 
-    list, with the newly added task selected.
+    :param offset: Current offset of task pad
+
+    Create new :class:`Task` object, append it to the task list and insert it
+    in the items list. Draw the updated list, with the newly added task 
+    selected, and return the new offset.
 
     """
     # Get input
@@ -22,17 +177,13 @@ def add_task():
     # Create task
     task = Task(summary=summary, description=description)
     task_list.add_task(task)
-    task_list.write_tasks()
-    # Adapt items dictionary and task pad to new task list
-    new_index = len(items)
-    items[new_index] = task
-    task_pad.resize(len(items), screen_width - 1)
-    # Compute new offset
-    sminrow, smincol = task_pad.getbegyx()
-    offset = len(items) - task_endrow + sminrow - 1
-    # offset is negative if number of tasks is lower than task pad height
-    offset = max(offset, 0)
-    draw_tasks(offset=offset, selected=new_index)
+    writer.schedule()
+    if not list_view['query'].matches(task):
+        write_status("Added %s, which this view does not show" % task)
+        return offset
+    new_index = items.insert(task)
+    reset_view()
+    offset = select(new_index, offset)
     write_status("Added %s" % task)
     return offset
 
@@ -53,10 +204,9 @@ def current_item(window, offset):
 def done_task(offset):
     """Mark task done.
 
-    Change selected task's status to 'completed', remove it from the task list
-    and synchronize the items dictionary.
+    Change selected task's status to 'completed' and remove it from the items
+    list.
     """
-    global items
     # Locate the done task
     y, x = curses.getsyx()
     sminrow, smincol = task_pad.getbegyx()
@@ -64,10 +214,13 @@ def done_task(offset):
     # Remove the task from the task list and mark it completed
     try:
         task = items.pop(item)
-    except KeyError:
-        return 0
-    task.status = 'completed'
-    task_list.write_tasks()
+    except IndexError:
+        return offset
+    if task.uid in timers.timers:
+        now = datetime.now()
+        stop_timer(task, timers.stop(task.uid, now), now)
+    task_list.update_task(task, status='completed')
+    writer.schedule()
     # Select the next item in the list, if there is one
     if item < len(items):
         selected = item
@@ -77,37 +230,44 @@ def done_task(offset):
         # Adjust offset if y is in the first row of the visible pad
         if y == sminrow:
             offset -= 1
-    tasks = items.values()
-    items = sync_items(tasks)
+    reset_view()
     draw_tasks(offset=offset, selected=selected)
     write_status("Done task: %s" % task)
     return offset
     
-def edit_time(task, operation_string):
-    """Increase or decrease logged time for a task.
+def edit_time(offset, operation_string):
+    """Increase or decrease logged time for the selected task.
 
-    :param task: class:`Task` object.
+    :param offset: Current offset of task pad
     :param operation_string: a string, 'add' or 'sub', to increase or decrease
                              logged time, respectively.
 
+    Return the new offset, since the task may move in the sorted list.
+
     """
+    from dateutil import parser as date_parser
+    task = items[current_item(task_pad, offset)]
     operation = getattr(operator, operation_string)
     input_str = get_input("%s time: " % operation_string.title())
     try:
         time_change = date_parser.parse(input_str)
     except ValueError:
         write_status("Could not parse time.")
-    else:
-        # date parser creates the time on current day
-        # the following subtraction yields the desired timedelta
-        delta = time_change - datetime(time_change.year, 
-                                       time_change.month, 
-                                       time_change.day)
-        # 86400 seconds in a day
-        delta_seconds = delta.days * 86400 + delta.seconds
-        task.logged_time = operation(task.logged_time, delta_seconds)
-        task.logged_time = max(0, task.logged_time)
-        show_details(task)
+        return offset
+    # date parser creates the time on current day
+    # the following subtraction yields the desired timedelta
+    delta = time_change - datetime(time_change.year, 
+                                   time_change.month, 
+                                   time_change.day)
+    # 86400 seconds in a day
+    delta_seconds = delta.days * 86400 + delta.seconds
+    logged_time = operation(task.logged_time, delta_seconds)
+    task_list.update_task(task, logged_time=max(0, logged_time))
+    writer.schedule()
+    show_details(task)
+    index = items.update(task)
+    reset_view()
+    return select(index, offset)
 
 def get_input(prompt_string):
     """Read input string from user."""
@@ -122,6 +282,283 @@ def get_input(prompt_string):
     stdscr.refresh()
     return input_string
 
+def open_task_list(backend, fsync='rewrite', name='tasks'):
+    """Open the task list.
+
+    :param backend: 'csv' or 'sqlite'.
+    :param fsync: fsync policy of the .csv backend.
+    :param name: Name of the task list, which is kept in NAME.csv or 
+                 NAME.db.
+
+    Open the task list lazily, so that only open tasks are read. The .csv 
+    backend moves finished tasks to its archive when it compacts the 
+    journal. The first time the SQLite backend is used, migrate the tasks 
+    in the .csv file.
+
+    """
+    csv_filename = name + ".csv"
+    if backend == 'sqlite':
+        csv_list = TaskListCSV(read=False, filename=csv_filename)
+        csv_files = [csv_list.filename, csv_list.journal_filename]
+        if (not os.path.exists(name + ".db") and 
+            any(os.path.exists(filename) for filename in csv_files)):
+            return migrate_csv_to_sqlite(csv_filename, name + ".db")
+        return TaskListSQLite(lazy=True, filename=name + ".db")
+    return TaskListCSV(journal=True, lazy=True, fsync=fsync, archive=True,
+                       filename=csv_filename)
+
+def load_tasks(backend, fsync, name):
+    """Open the task list and sort the tasks shown by the first view.
+
+    :param backend: 'csv' or 'sqlite'.
+    :param fsync: fsync policy of the .csv backend.
+    :param name: Name of the task list.
+
+    Return the task list and an :class:`ItemList` of the tasks.
+
+    """
+    task_list = open_task_list(backend, fsync, name)
+    mark_startup('task list read')
+    list_view['query'] = VIEWS[list_view['index']][1]()
+    tasks = ItemList(task_list.query(list_view['query']))
+    mark_startup('first view sorted')
+    return task_list, tasks
+
+def start_loading(backend, fsync, name):
+    """Start :func:`load_tasks` in a background thread.
+
+    Return a function that waits for the thread and returns what 
+    :func:`load_tasks` returned, or raises its exception. SQLite 
+    connections can only be used from the thread that opened them, so that
+    backend is loaded by the returned function itself.
+
+    """
+    if backend == 'sqlite':
+        return lambda: load_tasks(backend, fsync, name)
+    result = {}
+
+    def run():
+        try:
+            result['loaded'] = load_tasks(backend, fsync, name)
+        except BaseException:
+            result['error'] = sys.exc_info()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        thread.join()
+        if 'error' in result:
+            error_type, error, traceback = result['error']
+            raise error_type, error, traceback
+        return result['loaded']
+
+    return wait
+
+def finish_loading():
+    """Wait for the task list and show the tasks of the first view."""
+    loaded_list, loaded_items = wait_for_tasks()
+    mark_startup('tasks loaded')
+    list_states[args.list] = list_state(loaded_list, loaded_items, list_view,
+                                        timers, session_log)
+    registry.add(args.list, loaded_list)
+    use_list(args.list)
+    reset_view()
+    draw_tasks()
+    mark_startup('all tasks drawn')
+
+def list_state(task_list, items, list_view, timers, session_log):
+    """Return a dictionary with what the interface keeps for a task list.
+
+    It holds the task list, its :class:`WriteBehind`, timers and session 
+    log, the shown items, the view and the strings drawn for its tasks; 
+    :func:`use_list` makes them current. Closing the list drops them all.
+
+    """
+    # SQLite connections can only be used from the thread that opened them
+    if isinstance(task_list, TaskListSQLite):
+        writer = WriteBehind(task_list, delay=None)
+    else:
+        writer = WriteBehind(task_list, delay=args.write_delay)
+    return {'task_list': task_list, 'writer': writer, 'timers': timers, 
+            'session_log': session_log, 'items': items, 
+            'list_view': list_view, 'render_cache': {}}
+
+def open_list(name):
+    """Open the task list called name for :data:`registry`.
+
+    Its timers and session log are kept in NAME.timers and NAME.sessions, 
+    and it is shown with the first view.
+
+    """
+    task_list = open_task_list(args.backend, args.fsync, name)
+    view_query = VIEWS[0][1]()
+    list_states[name] = list_state(
+        task_list, ItemList(task_list.query(view_query)), 
+        {'index': 0, 'query': view_query},
+        TimerSet(args.checkpoint_interval, filename=name + ".timers"),
+        SessionLog(filename=name + ".sessions"))
+    return task_list
+
+def close_list(name, task_list):
+    """Save and forget the state of a task list closed by :data:`registry`.
+
+    Open timers are checkpointed, so that the next run resumes them.
+
+    """
+    state = list_states.pop(name)
+    if state['timers'].timers:
+        state['timers'].checkpoint()
+    state['session_log'].save()
+    state['writer'].close()
+    save_first_screen(name, task_list)
+    if isinstance(task_list, TaskListCSV):
+        task_list.save_text_index()
+
+def use_list(name):
+    """Make the open task list called name the current one.
+
+    The globals that the interface works on are saved in the state of the 
+    current list, if it is still open, and set from the state of the list.
+
+    """
+    global task_list, writer, timers, session_log, items, list_view
+    global render_cache
+    state = list_states.get(current_list.get('name'))
+    if state is not None:
+        state.update(items=items, list_view=list_view)
+        current_list['previous'] = current_list['name']
+    state = list_states[name]
+    task_list, writer, timers = (state['task_list'], state['writer'], 
+                                 state['timers'])
+    session_log, items, list_view = (state['session_log'], state['items'], 
+                                     state['list_view'])
+    render_cache = state['render_cache']
+    current_list['name'] = name
+
+def switch_list(offset):
+    """Ask for the name of a task list and show its tasks.
+
+    :param offset: Current offset of task pad
+
+    An empty name goes back to the previous list. Lists kept open by 
+    :data:`registry` are shown without reading them, after merging changes
+    made elsewhere; others are opened, and their timers left open resumed.
+    Lists with open timers are kept open. Return the new offset.
+
+    """
+    name = get_input("List (empty for the previous one): ").strip()
+    name = name or current_list.get('previous')
+    if not name or name == current_list['name']:
+        write_status("Showing list %s" % current_list['name'])
+        return offset
+    registry.pinned = set(pinned for pinned, state in list_states.iteritems()
+                          if state['timers'].timers)
+    opened = name not in registry.lists
+    registry.get(name)
+    use_list(name)
+    if not opened and task_list.refresh():
+        items.replace(view_tasks())
+    reset_view()
+    draw_tasks()
+    if opened:
+        recover_timers()
+    write_status("Showing list %s (%d %s tasks)" % (
+        name, len(items), VIEWS[list_view['index']][0]))
+    return 0
+
+def stop_all_timers():
+    """Stop the timers of all open task lists."""
+    for name in list(list_states):
+        use_list(name)
+        stop_timers()
+
+def list_signature(backend, name):
+    """Return the modification time and size of the task list files."""
+    if backend == 'sqlite':
+        filenames = [name + ".db"]
+    else:
+        csv_list = TaskListCSV(read=False, filename=name + ".csv")
+        filenames = [csv_list.filename, csv_list.journal_filename]
+    signature = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            signature.append(None)
+        else:
+            signature.append((stat.st_mtime, stat.st_size))
+    return tuple(signature)
+
+def draw_first_screen():
+    """Draw the first page of tasks saved by :func:`save_first_screen`.
+
+    The page is drawn only if the task list files have not changed since it
+    was saved, so that it shows what reading them will show. Keys are not 
+    read until :func:`finish_loading` replaces it with the whole list. 
+    Return True if the page was drawn.
+
+    """
+    global items
+    try:
+        with open(args.list + ".screen", "rb") as fh:
+            signature, count, rows = marshal.load(fh)
+    except (IOError, EOFError, ValueError, TypeError):
+        return False
+    if signature != list_signature(args.backend, args.list):
+        return False
+    items = ItemList(Task(*fields) for fields in rows)
+    draw_tasks()
+    if items:
+        write_status("Task 1 of %d (loading)" % count)
+    mark_startup('first screen drawn')
+    return True
+
+def save_first_screen(name, task_list):
+    """Save the first page of the first view for :func:`draw_first_screen`.
+
+    :param name: Name of the task list; the page is saved in NAME.screen.
+    :param task_list: The task list.
+
+    Call this after the last change to the task list is written. If the 
+    page cannot be saved, the next run draws the whole list when it is 
+    read.
+
+    """
+    tasks = task_list.query(VIEWS[0][1]())
+    page = heapq.nsmallest(task_endrow + 1, tasks, 
+                           key=ItemList.sort_keys['date'])
+    try:
+        with replaced_file(name + ".screen") as fh:
+            marshal.dump((list_signature(args.backend, name), len(tasks), 
+                          [task_fields(task) for task in page]), fh)
+    except (IOError, OSError):
+        pass
+
+def mark_startup(phase):
+    """Record the end of a startup phase for :func:`startup_report`."""
+    startup_times.append((phase, time.time()))
+
+def startup_report():
+    """Return the time taken by each startup phase, as lines of text.
+
+    Phases are listed in the order they ended, with the milliseconds since
+    the previous one ended and since the imports started. The task list is
+    read while the screen is set up and the first page drawn, so phases of
+    the two overlap.
+
+    """
+    times = sorted(startup_times, key=operator.itemgetter(1))
+    start = previous = times[0][1]
+    lines = ["%-28s %10s %10s\n" % ('phase', 'ms', 'total ms')]
+    for phase, end in times[1:]:
+        lines.append("%-28s %10.1f %10.1f\n" % (phase, 
+                                               (end - previous) * 1000, 
+                                               (end - start) * 1000))
+        previous = end
+    return ''.join(lines)
+
 def move(window, display_function, smaxrow, offset, operation_string):
     """Select previous or next item in list.
     
@@ -168,37 +605,118 @@ def write_status(status):
 
     """
     y, x = curses.getsyx()
-    status_bar.clear()
+    status_bar.erase()
     status_bar.addstr(str(status))
     status_bar.refresh()
     stdscr.move(y, x)
     stdscr.refresh()
 
+@instrumented('draw_tasks')
 def draw_tasks(offset=0, selected=0):
     """Draw task list on screen, highlighting selected task.
 
     :param offset: Offset of the task pad.
     :param selected: Index of selected item.
+
+    Only the visible items, from offset to the last row of the task pad, are
+    drawn. If the offset has not changed since the last call, only the 
+    previously selected row and the newly selected one are repainted.
     
     """
-    task_pad.clear()
     if not items:
+        task_pad.erase()
         task_pad.refresh(0, 0, 0, 0, task_endrow, screen_width)
         # Empty details window if no items exist
         show_details(None)
         return 0
-    for index, item in items.iteritems():
-        # Justify item string so it extends to the end of the screen
-        item = unicode(item.summary, 'utf8').ljust(screen_width - 2)
-        args = [index, 0, item.encode('utf8')]
-        if index == selected:
-            args.append(curses.A_REVERSE)
-        task_pad.addstr(*args)
-    task_pad.move(selected, 0)
-    task_pad.refresh(offset, 0, 0, 0, task_endrow, screen_width)
+    if view.get('offset') == offset:
+        draw_row(view['selected'] - offset, items[view['selected']])
+    else:
+        task_pad.erase()
+        last = min(len(items), offset + task_endrow + 1)
+        for index in xrange(offset, last):
+            draw_row(index - offset, items[index])
+    draw_row(selected - offset, items[selected], curses.A_REVERSE)
+    view.update(offset=offset, selected=selected)
+    task_pad.move(selected - offset, 0)
+    task_pad.refresh(0, 0, 0, 0, task_endrow, screen_width)
     show_details(items[selected])
     write_status("Task %s of %s" % (selected + 1, len(items)))
 
+def draw_row(row, task, attr=curses.A_NORMAL):
+    """Draw a task in a row of the task pad.
+
+    :param row: Row of the task pad.
+    :param task: :class:`Task` object to draw.
+    :param attr: Curses attribute for the row.
+
+    If the task is timed, the time elapsed ends the row.
+
+    """
+    entry = rendered(task)
+    if task.uid in timers.timers:
+        clock = u" %s" % timedelta(seconds=timers.elapsed(task.uid))
+        line = entry[_LINE][:screen_width - 2 - len(clock)] + clock
+        task_pad.addstr(row, 0, line.encode('utf8'), attr)
+    else:
+        task_pad.addstr(row, 0, entry[_ENCODED_LINE], attr)
+
+def rendered(task):
+    """Return the strings drawn for a task, preparing them if needed.
+
+    They are kept in :data:`render_cache` with the task, its 
+    :attr:`Task.version` and the screen width, and prepared again only when
+    one of those changed. Return a tuple of the task, its version, the 
+    width, the row as unicode and encoded, and the lines of the details 
+    window.
+
+    """
+    entry = render_cache.get(task.uid)
+    if (entry is None or entry[_TASK] is not task or 
+        entry[_VERSION] != task.version or entry[_WIDTH] != screen_width):
+        # Justify item string so it extends to the end of the screen
+        line = unicode(task.summary, 'utf8').ljust(screen_width - 2)
+        details = (task.created.strftime("%d/%m/%Y"), 
+                   task.summary, 
+                   task.description, 
+                   task.status, 
+                   format_seconds(task.logged_time))
+        entry = (task, task.version, screen_width, line, line.encode('utf8'),
+                 details)
+        render_cache[task.uid] = entry
+    return entry
+
+def shown_timers():
+    """Return the uids of the timed tasks drawn on the task pad."""
+    if not timers.timers or not view:
+        return []
+    last = min(len(items), view['offset'] + task_endrow + 1)
+    return [items[index].uid for index in xrange(view['offset'], last)
+            if items[index].uid in timers.timers]
+
+def draw_timers():
+    """Repaint the rows of the timed tasks drawn on the task pad."""
+    uids = shown_timers()
+    if not uids:
+        return
+    offset, selected = view['offset'], view['selected']
+    last = min(len(items), offset + task_endrow + 1)
+    for index in xrange(offset, last):
+        if items[index].uid in uids:
+            draw_row(index - offset, items[index], 
+                     curses.A_REVERSE if index == selected 
+                     else curses.A_NORMAL)
+    task_pad.move(selected - offset, 0)
+    task_pad.refresh(0, 0, 0, 0, task_endrow, screen_width)
+
+def reset_view():
+    """Forget the rows drawn, so that draw_tasks repaints all of them.
+
+    Call this after items are added or removed.
+
+    """
+    view.clear()
+
 
 def format_seconds(seconds):
     """Turn seconds into human-friendly time.
@@ -232,6 +750,7 @@ def query_plural(quantity):
     return ""
 
 
+@instrumented('show_details')
 def show_details(task):
     """Show details of selected task.
 
@@ -240,107 +759,316 @@ def show_details(task):
     Write details of selected task to the details window.
 
     """
-    details_win.clear()
+    details_win.erase()
     if not task:
         details_win.refresh()
         return 0
     # Locate cursor so it can be returned to this position later
     y, x = curses.getsyx()
     # Write task variables to details window
-    date = date_parser.parse(task.date)
-    details_win.addstr(0, 0, date.strftime("%d/%m/%Y"))
-    details_win.addstr(1, 0, task.summary, curses.A_BOLD)
-    details_win.addstr(2, 0, task.description)
-    details_win.addstr(3, 0, task.status)
-    details_win.addstr(4, 0, format_seconds(task.logged_time))
+    created, summary, description, status, logged_time = (
+        rendered(task)[_DETAILS])
+    details_win.addstr(0, 0, created)
+    details_win.addstr(1, 0, summary, curses.A_BOLD)
+    details_win.addstr(2, 0, description)
+    details_win.addstr(3, 0, status)
+    details_win.addstr(4, 0, logged_time)
     details_win.refresh()
     # Move cursor to previous position
     stdscr.move(y, x)
     stdscr.refresh()
 
-def stop_timer(task, logged_time):
+def show_timesheet():
+    """Show time logged on each day of the current week.
+
+    Totals come from the session log rollups, so no sessions are read.
+
+    """
+    details_win.erase()
+    y, x = curses.getsyx()
+    today = date.today()
+    monday = today - timedelta(days=today.weekday())
+    timesheet = session_log.timesheet(monday, today)
+    for row, (day, seconds) in enumerate(timesheet):
+        details_win.addstr(row, 0, day.strftime("%a %d/%m"))
+        details_win.addstr(row, 11, format_seconds(seconds) or '-')
+    details_win.addstr(len(timesheet), 0, "Week", curses.A_BOLD)
+    details_win.addstr(len(timesheet), 11, 
+                       format_seconds(session_log.week_total(today)) or '-')
+    details_win.refresh()
+    stdscr.move(y, x)
+    stdscr.refresh()
+
+def show_stats():
+    """Show the counters and call timings collected by the hot paths.
+
+    Calls are listed by total time spent, as many as fit in the details 
+    window, with their count and 50th and 99th percentile in milliseconds.
+
+    """
+    if taskmage.stats is None:
+        write_status("Set TASKMAGE_STATS to a file name to collect stats.")
+        return
+    summary = taskmage.stats.summary()
+    details_win.erase()
+    y, x = curses.getsyx()
+    height, width = details_win.getmaxyx()
+    counters = "  ".join("%s %d" % item 
+                         for item in sorted(summary['counters'].items()))
+    lines = [counters, "%-20s %8s %9s %9s" % ("", "calls", "p50 ms", 
+                                              "p99 ms")]
+    calls = sorted(summary['calls'].items(), 
+                   key=lambda item: item[1]['total'], reverse=True)
+    for name, call in calls:
+        lines.append("%-20s %8d %9.2f %9.2f" % (
+            name, call['calls'], call['p50'] * 1000, call['p99'] * 1000))
+    for row, line in enumerate(lines[:height]):
+        details_win.addstr(row, 0, line[:width - 1], 
+                           curses.A_BOLD if row == 1 else curses.A_NORMAL)
+    details_win.refresh()
+    stdscr.move(y, x)
+    stdscr.refresh()
+
+def stop_timer(task, start, end):
     """Stop task timer.
 
     :param task: class:`Task` object.
-    :param logged_time: Number of seconds elapsed since timer started.
+    :param start: :class:`datetime.datetime` when the timer started.
+    :param end: :class:`datetime.datetime` when the timer stopped.
+
+    Add the elapsed time to the task and log the timing session.
 
     """
-    task.logged_time += logged_time.seconds
-    task_list.write_tasks()
+    seconds = total_seconds(end - start)
+    task_list.update_task(task, logged_time=task.logged_time + seconds)
+    writer.schedule()
+    session_log.add_session(task.uid, start, end)
     show_details(task)
-    status = "Logged %s." % format_seconds(logged_time.seconds)
+    status = "Logged %s." % format_seconds(seconds)
     write_status(status)
 
-def sync_items(tasks):
-    """Synchronize items dictionary with current task list.
+def week_start():
+    """Return the date of this week's Monday."""
+    today = date.today()
+    return today - timedelta(days=today.weekday())
 
-    :param tasks: list of :class:`Task` objects
+def view_tasks():
+    """Return the tasks shown by the current view.
 
-    Return a dictionary where keys are integers and values are :class:`Task`
-    instances.
+    The query of the view is built again, and kept for checking new tasks.
 
     """
-    id_list = xrange(len(tasks))
-    # Sort tasks to avoid changing order if the TaskList provider does not
-    # produce task lists in a consistent order
-    items = dict(zip(id_list, sorted(tasks)))
-    return items
+    name, view_query = VIEWS[list_view['index']]
+    list_view['query'] = view_query()
+    return task_list.query(list_view['query'])
+
+def switch_view():
+    """Show the tasks of the next view, with the first one selected.
+
+    Return the new offset.
 
-def time_task(offset):
-    """Log time to task.
+    """
+    list_view['index'] = (list_view['index'] + 1) % len(VIEWS)
+    items.replace(view_tasks())
+    reset_view()
+    draw_tasks()
+    write_status("Showing %s tasks (%d)" % (VIEWS[list_view['index']][0], 
+                                            len(items)))
+    return 0
+
+def reload_tasks(offset):
+    """Show changes made to the task list by other processes.
 
     :param offset: Current offset of task pad
 
-    Display time logged every second and write it to the task when finished.
+    If the task list merged any changes, rebuild the items list, keeping the
+    selected task selected if the current view still shows it. Return the 
+    new offset.
 
     """
+    if not task_list.refresh():
+        return offset
     item = current_item(task_pad, offset)
-    task = items[item]
-    t0 = datetime.now()
-    status = "Started at %s" % datetime.now().strftime("%H:%M")
-    write_status(status)
-    # With halfdelay on, getch returns -1 every second if no key is pressed
-    curses.halfdelay(10)
-    while 1:
-        c = stdscr.getch()
-        t1 = datetime.now()
-        logged_time = t1 - t0
-        if c == -1:
-            logged_str = str(logged_time).split('.')[0]
-            timed_status = "%s -- %s" % (status, logged_str)
-            write_status(timed_status)
-        elif c == ord('+'):
-            edit_time(task, 'add')
-            # Restore halfdelay to continue timer
-            curses.halfdelay(10)
-        elif c == ord('-'):
-            edit_time(task, 'sub')
-            # Restore halfdelay to continue timer
-            curses.halfdelay(10)
-        elif c == ord('t'):
-            stop_timer(task, logged_time)
-            curses.cbreak()
-            break
-        elif c == ord('q'):
-            stop_timer(task, logged_time)
-            # Pass 'q' to next getch in the main loop, so we can quit from here
-            curses.ungetch('q')
-            break
-    
+    selected = items[item] if item < len(items) else None
+    items.replace(view_tasks())
+    reset_view()
+    if selected in items:
+        offset = select(items.index(selected), offset)
+    elif items:
+        offset = select(min(item, len(items) - 1), offset)
+    else:
+        offset = 0
+        draw_tasks()
+    write_status("Reloaded tasks changed elsewhere")
+    return offset
+
+def search_tasks(offset, query=None):
+    """Select the next task that matches a search query.
+
+    :param offset: Current offset of task pad
+    :param query: Query to search for; if None, ask for a new query.
+
+    Look up the query in the text index of the task list and select the 
+    first matching item after the selected one, wrapping around to the top.
+    Return the new offset.
+
+    """
+    if query is None:
+        query = get_input('Search: ')
+        last_search['query'] = query
+    if not query:
+        return offset
+    matches = [items.index(task) for task in task_list.search_tasks(query)
+               if task in items]
+    if not matches:
+        write_status("No tasks match '%s'" % query)
+        return offset
+    current = current_item(task_pad, offset)
+    later = [index for index in matches if index > current]
+    index = min(later) if later else min(matches)
+    offset = select(index, offset)
+    write_status("Match %d of %d for '%s'" % (
+        sorted(matches).index(index) + 1, len(matches), query))
+    return offset
+
+def select(index, offset):
+    """Draw the task list with an item selected, scrolling to show it.
+
+    :param index: Index of the item to select.
+    :param offset: Current offset of task pad
+
+    Return the new offset.
+
+    """
+    if index < offset:
+        offset = index
+    elif index > offset + task_endrow:
+        offset = index - task_endrow
+    draw_tasks(offset=offset, selected=index)
+    return offset
+
+def sort_items(offset):
+    """Sort items by the next sort key, keeping the selected task selected.
+
+    :param offset: Current offset of task pad
+
+    Return the new offset.
+
+    """
+    orders = ItemList.sort_orders
+    sort_order = orders[(orders.index(items.sort_order) + 1) % len(orders)]
+    selected = items[current_item(task_pad, offset)] if items else None
+    items.sort_by(sort_order)
+    reset_view()
+    if selected is not None:
+        offset = select(items.index(selected), offset)
+    write_status("Sorted by %s" % sort_order.replace('_', ' '))
+    return offset
+
+def toggle_timer(offset):
+    """Start or stop the timer of the selected task.
+
+    :param offset: Current offset of task pad
+
+    Any number of tasks can be timed at once; the time elapsed is shown in
+    their rows. Stopping a timer adds the elapsed time to the task. Return 
+    the new offset, since the task may move in the sorted list.
+
+    """
+    if not items:
+        return offset
+    task = items[current_item(task_pad, offset)]
+    now = datetime.now()
+    if task.uid in timers.timers:
+        stop_timer(task, timers.stop(task.uid, now), now)
+    else:
+        timers.start(task.uid, now)
+        write_status("Started at %s" % now.strftime("%H:%M"))
+    index = items.update(task)
+    reset_view()
+    return select(index, offset)
+
+def stop_timers():
+    """Stop all timers, adding the time elapsed to their tasks."""
+    now = datetime.now()
+    for uid in list(timers.timers):
+        start = timers.stop(uid, now)
+        task = task_list.uids.get(uid)
+        if task is not None:
+            stop_timer(task, start, now)
+
+def recover_timers():
+    """Resume the timers left open by processes that did not stop them.
+
+    The time up to their last checkpoint is added to their tasks, and the
+    timers of tasks still listed start again.
+
+    """
+    recovered = 0
+    for uid, start, checkpoint in timers.recover():
+        task = task_list.uids.get(uid)
+        if task is None:
+            continue
+        stop_timer(task, start, checkpoint)
+        if task in items:
+            items.update(task)
+            if uid not in timers.timers:
+                timers.start(uid)
+        recovered += 1
+    if recovered:
+        reset_view()
+        draw_tasks()
+        write_status("Recovered %d timer%s" % (recovered, 
+                                               query_plural(recovered)))
+
+def terminate(signum, frame):
+    """Exit on SIGTERM or SIGHUP, so that pending changes are saved."""
+    raise SystemExit(128 + signum)
 
 def main(stdscr):
     """Main program loop.
 
     :param stdscr: Curses main screen.
 
-    Draw initial list of tasks, wait for input and act accordingly.
+    Draw the first page of tasks, saved by the last run, while the task list
+    is read, then the whole list of tasks; wait for input and act 
+    accordingly.
 
     """
-    draw_tasks()
+    if not draw_first_screen():
+        write_status("Loading tasks...")
+    finish_loading()
+    if args.startup_report:
+        return
+    recover_timers()
     # Offset variable keeps track of which part of the task pad is displayed
     offset = 0
+    next_refresh = datetime.now() + refresh_interval
     while 1:
-        c = task_pad.getkey()
+        if writer.error is not None:
+            write_status("Could not write tasks: %s" % writer.error)
+            writer.error = None
+        now = datetime.now()
+        for state in list_states.itervalues():
+            if state['timers'].checkpoint_due(now):
+                state['timers'].checkpoint(now)
+        # Look for changes made by other processes every few seconds
+        if now >= next_refresh:
+            offset = reload_tasks(offset)
+            next_refresh = now + refresh_interval
+        # Sleep until a shown timer ticks, a checkpoint is due or it is
+        # time to look for changes, unless a key is pressed
+        timeout = seconds_between(now, next_refresh)
+        wakeup = timers.next_wakeup(shown_timers(), now)
+        if wakeup is not None:
+            timeout = min(timeout, wakeup)
+        task_pad.timeout(int(timeout * 1000) + 1)
+        try:
+            c = task_pad.getkey()
+        except curses.error:
+            # No key was pressed before the timeout
+            draw_timers()
+            continue
         # Move down
         if c == 'j':
             offset = move(task_pad, draw_tasks, task_endrow, offset, 'add')
@@ -349,23 +1077,90 @@ def main(stdscr):
             offset = move(task_pad, draw_tasks, task_endrow, offset, 'sub')
         # Add task
         elif c == 'a':
-            offset = add_task()
+            offset = add_task(offset)
         # Mark task done
         elif c == 'd':
             offset = done_task(offset)
-        # Time task
+        # Start or stop the timer of the selected task
         elif c == 't':
-            time_task(offset)
+            offset = toggle_timer(offset)
+        # Add time to the selected task
+        elif c == '+' and items:
+            offset = edit_time(offset, 'add')
+        # Subtract time from the selected task
+        elif c == '-' and items:
+            offset = edit_time(offset, 'sub')
+        # Change sort order
+        elif c == 'o':
+            offset = sort_items(offset)
+        # Show the next view of the task list
+        elif c == 'v':
+            offset = switch_view()
+        # Show another task list
+        elif c == 'l':
+            offset = switch_list(offset)
+        # Show this week's timesheet
+        elif c == 'w':
+            show_timesheet()
+        # Show timings and counters of the hot paths
+        elif c == 's':
+            show_stats()
+        # Search tasks
+        elif c == '/':
+            offset = search_tasks(offset)
+        # Repeat last search
+        elif c == 'n':
+            offset = search_tasks(offset, last_search.get('query'))
         # Quit program
         elif c == 'q':
+            stop_all_timers()
             break
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage tasks.")
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv',
+                        help="task list storage (default: csv)")
+    parser.add_argument('--fsync', choices=TaskListCSV.fsync_policies,
+                        default='rewrite',
+                        help="when the csv backend forces writes to disk "
+                             "(default: rewrite)")
+    parser.add_argument('--write-delay', type=float, default=0.5,
+                        help="seconds to wait for more changes before "
+                             "writing (default: 0.5)")
+    parser.add_argument('--refresh-interval', type=float, default=2,
+                        help="seconds between checks for changes made by "
+                             "other processes (default: 2)")
+    parser.add_argument('--checkpoint-interval', type=float, default=60,
+                        help="seconds between saves of the open timers "
+                             "(default: 60)")
+    parser.add_argument('--list', default='tasks',
+                        help="name of the task list shown first, which is "
+                             "kept in NAME.csv or NAME.db (default: tasks)")
+    parser.add_argument('--memory-budget', type=float, default=128,
+                        help="megabytes of memory that the tasks of the "
+                             "lists kept open may take (default: 128)")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="start, print the time taken by each startup "
+                             "phase and exit")
+    args = parser.parse_args()
     locale.setlocale(locale.LC_ALL, "")
-    task_list = TaskListCSV()
     # Initially show only open tasks
-    tasks = task_list.filter_tasks(status=['needs-action', 'in-process'])
-    items = sync_items(tasks)
+    list_view = {'index': 0}
+    # Read the task list while the screen is set up; finish_loading sets
+    # the task list, its writer and the items
+    wait_for_tasks = start_loading(args.backend, args.fsync, args.list)
+    task_list = writer = None
+    items = ItemList()
+    refresh_interval = timedelta(seconds=args.refresh_interval)
+    timers = TimerSet(args.checkpoint_interval, 
+                      filename=args.list + ".timers")
+    session_log = SessionLog(filename=args.list + ".sessions")
+    # What the interface keeps for each open task list, by name, and the 
+    # names of the current and previous lists
+    list_states = {}
+    current_list = {}
+    registry = TaskListRegistry(open_list, close_list, 
+                                int(args.memory_budget * 1024 * 1024))
     # Initialize curses
     stdscr = curses.initscr()
     screen_height, screen_width = stdscr.getmaxyx()
@@ -373,8 +1168,13 @@ if __name__ == '__main__':
     status_bar_row = screen_height - 1
     status_bar = curses.newwin(1, screen_width, status_bar_row, 0)
     # Create task pad
-    task_pad = curses.newpad(max(len(items), 1), screen_width - 1)
     task_endrow = 15
+    # The task pad holds only the visible rows of the task list
+    task_pad = curses.newpad(task_endrow + 1, screen_width - 1)
+    # Offset and selected item drawn last by draw_tasks
+    view = {}
+    # Query of the last search, repeated by the 'n' key
+    last_search = {}
     # Create details window
     details_win = curses.newwin(screen_height - task_endrow - 4, 
                                 screen_width, 
@@ -385,5 +1185,15 @@ if __name__ == '__main__':
     stdscr.hline(status_bar_row - 1, 0, '=', screen_width)
     # Set cursor invisible
     curses.curs_set(0)
+    signal.signal(signal.SIGTERM, terminate)
+    if hasattr(signal, 'SIGHUP'):
+        # Sent when the terminal is closed
+        signal.signal(signal.SIGHUP, terminate)
+    mark_startup('screen set up')
     # Run main program loop
-    curses.wrapper(main)
+    try:
+        curses.wrapper(main)
+    finally:
+        registry.close_all()
+    if args.startup_report:
+        sys.stderr.write(startup_report())
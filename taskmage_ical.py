@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""
+Conversion between task lists and iCalendar (.ics) files.
+
+Tasks are written as VTODO components and VTODO components are read as
+tasks. Both directions are pipelines of generators over lines, so calendar
+files of any size are converted in little memory: lines are unfolded, parsed
+and grouped into components one at a time on import, and components are
+written and folded one task at a time on export.
+
+Exported functions:
+
+export_ics -- Yield the lines of an iCalendar file holding tasks.
+
+import_ics -- Append the VTODO components of an iCalendar file to a task
+              list.
+
+read_vtodos -- Yield the properties of each VTODO component in lines.
+
+Example:
+
+    python taskmage_ical.py export --status needs-action > tasks.ics
+    python taskmage_ical.py import calendar.ics
+"""
+
+import argparse
+import calendar
+import sys
+import time
+from datetime import datetime
+
+from taskmage import (STATUSES, Task, TaskListCSV, clean_field, 
+                      created_or_none)
+
+# Longest line, in octets and without the line break, allowed by RFC 5545
+LINE_LENGTH = 75
+# Property for the logged time, which iCalendar has no property for
+LOGGED_TIME = 'X-TASKMAGE-LOGGED-TIME'
+
+def export_ics(tasks):
+    """Yield the lines of an iCalendar file holding tasks.
+
+    :param tasks: Iterable of :class:`taskmage.Task` objects.
+
+    Each line is folded and ends with CRLF.
+
+    """
+    yield "BEGIN:VCALENDAR\r\n"
+    yield "VERSION:2.0\r\n"
+    yield "PRODID:-//taskmage//taskmage//EN\r\n"
+    for task in tasks:
+        for line in task_lines(task):
+            for part in fold(line):
+                yield part
+    yield "END:VCALENDAR\r\n"
+
+def task_lines(task):
+    """Yield the unfolded content lines of the VTODO component of task."""
+    yield "BEGIN:VTODO"
+    yield "UID:" + task.uid
+    created = created_or_none(task.date)
+    if created is not None:
+        yield "DTSTAMP:" + format_utc(created)
+        yield "CREATED:" + format_utc(created)
+    yield "SUMMARY:" + escape_text(task.summary or '')
+    if task.description:
+        yield "DESCRIPTION:" + escape_text(task.description)
+    yield "STATUS:" + task.status.upper()
+    if task.logged_time:
+        yield "%s:%d" % (LOGGED_TIME, task.logged_time)
+    yield "END:VTODO"
+
+def fold(line):
+    """Yield the parts of a content line folded at :data:`LINE_LENGTH`.
+
+    :param line: Content line, as a UTF-8 string without line break.
+
+    Parts after the first start with a space and all end with CRLF. Lines
+    are never folded inside a multi-octet UTF-8 character.
+
+    """
+    length = LINE_LENGTH
+    while len(line) > length:
+        end = length
+        # Back up to the first octet of a UTF-8 character
+        while end > 1 and '\x80' <= line[end] <= '\xbf':
+            end -= 1
+        yield line[:end] + "\r\n"
+        line = ' ' + line[end:]
+    yield line + "\r\n"
+
+def escape_text(text):
+    """Escape a TEXT property value."""
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+def unescape_text(text):
+    """Undo :func:`escape_text`."""
+    if '\\' not in text:
+        return text
+    parts = []
+    chars = iter(text)
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '')
+            if char in 'nN':
+                char = '\n'
+        parts.append(char)
+    return ''.join(parts)
+
+def format_utc(local):
+    """Return a naive local datetime as an iCalendar UTC date-time."""
+    utc = datetime.utcfromtimestamp(time.mktime(local.timetuple()))
+    return utc.strftime("%Y%m%dT%H%M%SZ")
+
+def parse_datetime(value):
+    """Return an iCalendar DATE or DATE-TIME as a naive local datetime.
+
+    :param value: For example, '20110829T173719Z', '20110829T173719' or
+                  '20110829'. Times in UTC are converted to local time;
+                  others are taken as local time.
+
+    """
+    value = value.strip()
+    fields = [int(value[0:4]), int(value[4:6]), int(value[6:8])]
+    if len(value) >= 15 and value[8] == 'T':
+        fields += [int(value[9:11]), int(value[11:13]), int(value[13:15])]
+    parsed = datetime(*fields)
+    if value.endswith('Z'):
+        return datetime.fromtimestamp(calendar.timegm(parsed.timetuple()))
+    return parsed
+
+def unfold(lines):
+    """Yield the logical content lines of an iCalendar file.
+
+    :param lines: Iterable of physical lines, with or without line breaks.
+
+    Lines that start with a space or a tab continue the previous line.
+
+    """
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current:
+        yield current
+
+def parse_line(line):
+    """Split a content line into its name, parameters and value.
+
+    Return a tuple with the upper case property name, a dictionary mapping
+    upper case parameter names to their values, and the raw value. Colons
+    and semicolons inside quoted parameter values are allowed.
+
+    """
+    quoted = False
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ':' and not quoted:
+            break
+    else:
+        raise ValueError("Content line without a value: %r" % line[:40])
+    head, value = line[:i], line[i + 1:]
+    params = {}
+    parts = head.split(';')
+    for part in parts[1:]:
+        name, _, param_value = part.partition('=')
+        params[name.upper()] = param_value.strip('"')
+    return parts[0].upper(), params, value
+
+def read_vtodos(lines):
+    """Yield the properties of each VTODO component in lines.
+
+    :param lines: Iterable of the physical lines of an iCalendar file.
+
+    Each VTODO is yielded as a dictionary mapping upper case property names
+    to their first raw value. Properties of components nested in a VTODO,
+    such as VALARM, and of other components are skipped, as are lines 
+    that cannot be parsed.
+
+    """
+    components = []
+    properties = None
+    for line in unfold(lines):
+        try:
+            name, params, value = parse_line(line)
+        except ValueError:
+            continue
+        if name == 'BEGIN':
+            components.append(value.upper())
+            if components[-1] == 'VTODO':
+                properties = {}
+        elif name == 'END':
+            if components and components.pop() == 'VTODO':
+                yield properties
+                properties = None
+        elif components and components[-1] == 'VTODO':
+            properties.setdefault(name, value)
+
+def vtodo_task(properties):
+    """Return a new :class:`taskmage.Task` from the properties of a VTODO."""
+    uid = properties.get('UID')
+    task = Task(uid=clean_field(uid) if uid else None,
+                summary=clean_field(unescape_text(
+                    properties.get('SUMMARY', ''))),
+                description=clean_field(unescape_text(
+                    properties.get('DESCRIPTION', ''))))
+    for name in ('CREATED', 'DTSTAMP'):
+        if name in properties:
+            try:
+                task.date = parse_datetime(properties[name]).isoformat()
+            except ValueError:
+                continue
+            break
+    if not task.date:
+        task.date = datetime.now().isoformat()
+    status = properties.get('STATUS', '').strip().lower()
+    if status in STATUSES:
+        task.status = status
+    elif 'COMPLETED' in properties:
+        task.status = 'completed'
+    try:
+        task.logged_time = int(properties.get(LOGGED_TIME, 0))
+    except ValueError:
+        pass
+    return task
+
+def import_ics(lines, task_list):
+    """Append the VTODO components of an iCalendar file to a task list.
+
+    :param lines: Iterable of the physical lines of an iCalendar file.
+    :param task_list: :class:`taskmage.TaskListCSV` object; its tasks need
+                      not be read.
+
+    Tasks whose uid is already in the task list, or earlier in the file,
+    are skipped: the uids are kept in a set, so each one is checked in
+    constant time. Return a tuple with the number of tasks added and
+    skipped.
+
+    """
+    uids = set(task_list.iter_uids())
+    skipped = [0]
+
+    def new_tasks():
+        for properties in read_vtodos(lines):
+            task = vtodo_task(properties)
+            if task.uid in uids:
+                skipped[0] += 1
+                continue
+            uids.add(task.uid)
+            yield task
+
+    added = task_list.append_tasks(new_tasks())
+    return added, skipped[0]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert tasks to and from iCalendar files.")
+    parser.add_argument('--list', default='tasks',
+                        help="name of the task list, which is kept in "
+                             "NAME.csv (default: tasks)")
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser(
+        'export', help="write tasks as an iCalendar file")
+    export_parser.add_argument('--status', action='append',
+                               help="export tasks with this status; may be "
+                                    "repeated (default: all tasks)")
+    export_parser.add_argument('filename', nargs='?', default='-',
+                               help="file to write (default: standard "
+                                    "output)")
+    import_parser = subparsers.add_parser(
+        'import', help="add the tasks in an iCalendar file")
+    import_parser.add_argument('filename', nargs='?', default='-',
+                               help="file to read (default: standard input)")
+    args = parser.parse_args(argv)
+    task_list = TaskListCSV(read=False, filename=args.list + ".csv")
+    if args.command == 'export':
+        criteria = {'status': args.status} if args.status else {}
+        fh = sys.stdout if args.filename == '-' else open(args.filename, "wb")
+        with fh:
+            fh.writelines(export_ics(task_list.iter_tasks(**criteria)))
+        return 0
+    fh = sys.stdin if args.filename == '-' else open(args.filename, "rb")
+    with fh:
+        added, skipped = import_ics(fh, task_list)
+    sys.stderr.write("Added %d tasks, skipped %d already present\n" %
+                     (added, skipped))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())